@@ -0,0 +1,106 @@
+"""持久化adb shell会话，只依赖标准库，供各测试脚本直接导入而不必加载performance_analysis"""
+import subprocess
+import os
+import select
+import threading
+
+class AdbShell:
+    """持久化的adb shell会话，复用同一个adb进程执行多条命令，避免每次调用都重新启动adb"""
+    
+    SENTINEL = b'__ADB_SHELL_END__'
+    
+    def __init__(self, device_id=None):
+        """device_id为空时连接adb默认设备"""
+        self.device_id = device_id
+        self.returncode = None
+        self._lock = threading.Lock()
+        self._proc = subprocess.Popen(
+            ['adb'] + (['-s', device_id] if device_id else []) + ['shell'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            # 独立会话，避免Ctrl-C直接终止adb子进程
+            start_new_session=True
+        )
+        # Linux 5.3+ 上通过pidfd等待子进程退出，避免轮询
+        self._pidfd = None
+        if hasattr(os, 'pidfd_open'):
+            try:
+                self._pidfd = os.pidfd_open(self._proc.pid)
+            except OSError:
+                self._pidfd = None
+    
+    def run(self, command):
+        """执行shell命令并返回输出（stderr合并到stdout），退出码保存在returncode中"""
+        return self.run_bytes(command).decode('utf-8', errors='replace')
+    
+    def run_bytes(self, command):
+        """执行shell命令并返回未解码的原始输出，适合只需提取少量字段的大段输出"""
+        with self._lock:
+            self.returncode = -1
+            if self._proc.poll() is not None:
+                return b""
+            
+            try:
+                self._proc.stdin.write(f"{{ {command}; }} 2>&1; echo {self.SENTINEL.decode()} $?\n".encode('utf-8'))
+                self._proc.stdin.flush()
+            except OSError as e:
+                print(f"执行命令失败: {command}")
+                print(f"错误信息: {str(e)}")
+                return b""
+            
+            # 逐行读取输出，直到遇到结束标记
+            lines = []
+            while True:
+                line = self._proc.stdout.readline()
+                if not line:
+                    break
+                index = line.find(self.SENTINEL)
+                if index < 0:
+                    lines.append(line)
+                    continue
+                if index > 0:
+                    lines.append(line[:index])
+                try:
+                    self.returncode = int(line[index + len(self.SENTINEL):].strip())
+                except ValueError:
+                    pass
+                break
+            
+            return b''.join(lines).strip()
+    
+    def close(self):
+        """关闭shell会话"""
+        if self._proc.poll() is None:
+            try:
+                self._proc.stdin.write(b"exit\n")
+                self._proc.stdin.flush()
+            except OSError:
+                pass
+            if not self._wait_exit(5):
+                self._proc.kill()
+                self._proc.wait()
+        if self._pidfd is not None:
+            os.close(self._pidfd)
+            self._pidfd = None
+        self._proc.stdin.close()
+        self._proc.stdout.close()
+    
+    def _wait_exit(self, timeout):
+        """等待shell进程退出，返回是否在超时前退出"""
+        if self._pidfd is not None:
+            poller = select.poll()
+            poller.register(self._pidfd, select.POLLIN)
+            if not poller.poll(timeout * 1000):
+                return False
+            self._proc.wait()
+            return True
+        try:
+            self._proc.wait(timeout=timeout)
+            return True
+        except subprocess.TimeoutExpired:
+            return False
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -12,6 +12,7 @@ import difflib
 import json
 import re
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 def get_similarity_ratio(str1, str2):
     """
@@ -229,13 +230,14 @@ def extract_text_from_image_wrapper(args):
         "matched": False
     }
 
-def extract_all_texts_from_folder(folder_path, search_text=None):
+def extract_all_texts_from_folder(folder_path, search_text=None, max_workers=None):
     """
     从文件夹中提取所有图片的文本
     
     Args:
         folder_path: 图片文件夹路径
         search_text: 要搜索的文本，如果提供则启用提前退出机制
+        max_workers: 并行OCR的进程数，默认为CPU核数，为1时顺序处理
         
     Returns:
         图片文件名到文本的映射字典
@@ -244,13 +246,21 @@ def extract_all_texts_from_folder(folder_path, search_text=None):
     image_files = glob.glob(os.path.join(folder_path, "*.png"))
     image_files.sort(key=lambda x: float(os.path.splitext(os.path.basename(x))[0]))
     
-    # 存储图片文本信息
-    image_texts = {}
-    
     print(f"正在从文件夹提取文本: {folder_path}")
     print(f"共找到 {len(image_files)} 张图片待处理...\n")
     
-    # 顺序处理每个图片
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    
+    if max_workers <= 1 or len(image_files) <= 1:
+        return _extract_texts_sequential(image_files, search_text)
+    return _extract_texts_parallel(image_files, search_text, max_workers)
+
+def _extract_texts_sequential(image_files, search_text):
+    """顺序处理每个图片，找到匹配时提前返回"""
+    # 存储图片文本信息
+    image_texts = {}
+    
     for i, image_path in enumerate(image_files):
         file_name = os.path.basename(image_path)
         result = extract_text_from_image_wrapper((image_path, search_text))[1]
@@ -269,6 +279,51 @@ def extract_all_texts_from_folder(folder_path, search_text=None):
     
     return image_texts
 
+def _extract_texts_parallel(image_files, search_text, max_workers):
+    """
+    使用进程池并行OCR
+    
+    找到匹配后取消序号更大的任务，但仍等待序号更小的图片处理完成，
+    保证返回的是时间上最早的匹配图片，与顺序处理的结果一致
+    """
+    results = [None] * len(image_files)
+    first_match = None
+    processed = 0
+    
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(extract_text_from_image_wrapper, (image_path, search_text)): i
+                   for i, image_path in enumerate(image_files)}
+        
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+            
+            i = futures[future]
+            results[i] = future.result()
+            processed += 1
+            
+            if search_text and results[i][1].get('matched', False) and (first_match is None or i < first_match):
+                first_match = i
+                for other, j in futures.items():
+                    if j > i:
+                        other.cancel()
+            
+            # 更早的图片都已处理完，当前匹配即为最早的匹配
+            if first_match is not None and all(results[j] is not None for j in range(first_match)):
+                break
+            
+            # 显示进度
+            if processed % 5 == 0 or processed == len(image_files):
+                print(f"已处理: {processed}/{len(image_files)} 张图片")
+    
+    if first_match is not None:
+        file_name, result = results[first_match]
+        print(f"\n在图片 {file_name} 中找到匹配文本，提前结束处理")
+        # 只返回包含匹配的图片，而不是所有已处理的图片
+        return {file_name: result}
+    
+    return dict(results)
+
 def save_extracted_texts(image_texts, output_file):
     """
     将提取的文本保存到JSON文件
@@ -5,7 +5,10 @@ import re
 import csv
 import datetime
 import argparse
+import signal
+import threading
 from pathlib import Path
+from adb_shell import AdbShell
 
 def run_adb_command(command, device_id=None):
     """执行adb命令并返回结果"""
@@ -64,28 +67,67 @@ def get_connected_devices():
         print(f"错误：检查设备连接时发生异常：{str(e)}")
         return []
 
-def is_app_installed(device_id, package_name):
-    """检查应用是否已安装"""
-    result = subprocess.run(['adb', '-s', device_id, 'shell', 'pm', 'list', 'packages', package_name],
-                            capture_output=True, text=True)
-    return package_name in result.stdout
+# 安装状态缓存的有效期（秒），避免重试或多次启动时重复查询
+INSTALL_CHECK_TTL = 30
+_install_cache = {}
 
-def launch_app(device_id, package_name):
+def is_app_installed(shell, package_name):
+    """检查应用是否已安装（结果在INSTALL_CHECK_TTL秒内复用）"""
+    key = (shell.device_id, package_name)
+    cached = _install_cache.get(key)
+    if cached and time.monotonic() - cached[1] < INSTALL_CHECK_TTL:
+        return cached[0]
+    
+    installed = package_name in shell.run(f'pm list packages {package_name}')
+    _install_cache[key] = (installed, time.monotonic())
+    return installed
+
+# 主Activity解析结果缓存，以(设备ID, 包名)为键，跨会话复用且不持有shell对象
+_activity_cache = {}
+
+def _resolve_activity(shell, package_name):
+    """解析应用的主Activity，同一设备和包名只查询一次"""
+    key = (shell.device_id, package_name)
+    if key not in _activity_cache:
+        _activity_cache[key] = shell.run(f'cmd package resolve-activity --brief {package_name}')
+    return _activity_cache[key]
+
+# 批量查询时分隔各条命令输出的标记
+QUERY_SEPARATOR = '__QUERY_SEP__'
+
+def _prepare_device(shell, package_name):
+    """一次shell往返完成安装检查、主Activity解析和设备型号查询，返回(是否已安装, 设备型号)
+
+    安装状态和主Activity结果写入各自的缓存，供后续is_app_installed和launch_app直接复用
+    """
+    output = shell.run(f'pm path {package_name}; echo {QUERY_SEPARATOR}; '
+                       f'cmd package resolve-activity --brief {package_name}; echo {QUERY_SEPARATOR}; '
+                       f'getprop ro.product.model')
+    parts = [part.strip() for part in output.split(QUERY_SEPARATOR)]
+    if len(parts) != 3:
+        # 输出异常时退回逐条查询
+        return is_app_installed(shell, package_name), run_adb_command('shell getprop ro.product.model', shell.device_id)
+    
+    path_output, activity_line, device_model = parts
+    installed = path_output.startswith('package:')
+    key = (shell.device_id, package_name)
+    _install_cache[key] = (installed, time.monotonic())
+    if activity_line and "No activity found" not in activity_line:
+        _activity_cache[key] = activity_line
+    return installed, device_model
+
+def launch_app(shell, package_name):
     """启动应用"""
-    print(f"正在启动应用 {package_name} 在设备 {device_id} 上...")
+    print(f"正在启动应用 {package_name} 在设备 {shell.device_id} 上...")
     # 获取应用的主Activity
-    result = subprocess.run(
-        ['adb', '-s', device_id, 'shell', 'cmd', 'package', 'resolve-activity', '--brief', package_name],
-        capture_output=True, text=True
-    )
-    
-    activity_line = result.stdout.strip()
+    activity_line = _resolve_activity(shell, package_name)
     if not activity_line or "No activity found" in activity_line:
+        # 解析失败的结果不缓存，下次启动时重新查询（只清除该设备和包名）
+        _activity_cache.pop((shell.device_id, package_name), None)
         print(f"错误：无法找到应用 {package_name} 的主Activity")
         # 尝试使用monkey启动应用
         print("尝试使用monkey启动应用...")
-        subprocess.run(['adb', '-s', device_id, 'shell', 'monkey', '-p', package_name, '-c', 'android.intent.category.LAUNCHER', '1'],
-                      capture_output=True)
+        shell.run(f'monkey -p {package_name} -c android.intent.category.LAUNCHER 1')
         return True
     
     # 解析主Activity
@@ -94,61 +136,55 @@ def launch_app(device_id, package_name):
         activity = package_name + activity
     
     # 启动应用
-    launch_result = subprocess.run(
-        ['adb', '-s', device_id, 'shell', 'am', 'start', '-n', f"{package_name}/{activity}"],
-        capture_output=True, text=True
-    )
+    launch_output = shell.run(f'am start -n {package_name}/{activity}')
     
-    if "Error" in launch_result.stdout or "Error" in launch_result.stderr:
-        print(f"错误：启动应用失败：{launch_result.stderr if launch_result.stderr else launch_result.stdout}")
+    if "Error" in launch_output:
+        print(f"错误：启动应用失败：{launch_output}")
         return False
     
     print("应用启动成功")
     return True
 
-def get_memory_info(device_id, package_name):
+# dumpsys meminfo中需要提取的行前缀及对应字段，'TOTAL PSS:'须排在'TOTAL'之前
+MEMINFO_FIELDS = (
+    ('TOTAL PSS:', 'pss_total'),
+    ('Java Heap:', 'java_heap'),
+    ('Native Heap:', 'native_heap'),
+    ('TOTAL', 'total'),
+)
+
+def get_memory_info(shell, package_name):
     """获取应用内存使用情况"""
-    result = subprocess.run(
-        ['adb', '-s', device_id, 'shell', 'dumpsys', 'meminfo', package_name],
-        capture_output=True, text=True
-    )
+    output = shell.run(f'dumpsys meminfo {package_name}')
     
-    output = result.stdout
-    
-    # 解析内存信息
+    # 解析内存信息：逐行扫描一遍，按行前缀匹配，取每个字段第一次出现的数值
     memory_data = {}
-    
-    # 提取总内存使用量
-    total_match = re.search(r'TOTAL\s+([\d,]+)', output)
-    if total_match:
-        memory_data['total'] = int(total_match.group(1).replace(',', ''))
-    
-    # 提取Java堆内存
-    java_heap_match = re.search(r'Java Heap:\s+([\d,]+)', output)
-    if java_heap_match:
-        memory_data['java_heap'] = int(java_heap_match.group(1).replace(',', ''))
-    
-    # 提取原生堆内存
-    native_heap_match = re.search(r'Native Heap:\s+([\d,]+)', output)
-    if native_heap_match:
-        memory_data['native_heap'] = int(native_heap_match.group(1).replace(',', ''))
-    
-    # 提取PSS总和
-    pss_total_match = re.search(r'TOTAL PSS:\s+([\d,]+)', output)
-    if pss_total_match:
-        memory_data['pss_total'] = int(pss_total_match.group(1).replace(',', ''))
+    for line in output.splitlines():
+        stripped = line.strip()
+        for prefix, key in MEMINFO_FIELDS:
+            if stripped.startswith(prefix):
+                break
+        else:
+            continue
+        
+        rest = stripped[len(prefix):]
+        if key in memory_data or not rest[:1].isspace():
+            continue
+        value = rest.split(None, 1)[0].replace(',', '')
+        if value.isdigit():
+            memory_data[key] = int(value)
+            if len(memory_data) == len(MEMINFO_FIELDS):
+                break
     
     return memory_data
 
-def save_detailed_memory_info(device_id, package_name, timestamp, results_dir):
+def save_detailed_memory_info(shell, package_name, timestamp, results_dir):
     """获取并保存应用的详细内存信息"""
+    device_id = shell.device_id
     # 执行adb shell dumpsys meminfo命令获取完整内存信息
-    result = subprocess.run(
-        ['adb', '-s', device_id, 'shell', 'dumpsys', 'meminfo', package_name],
-        capture_output=True, text=True
-    )
+    output = shell.run(f'dumpsys meminfo {package_name}')
     
-    if result.returncode != 0:
+    if shell.returncode != 0:
         print(f"错误：获取应用 {package_name} 的详细内存信息失败")
         return
     
@@ -164,50 +200,36 @@ def save_detailed_memory_info(device_id, package_name, timestamp, results_dir):
     with open(meminfo_file, 'w', encoding='utf-8') as f:
         f.write(f"===== 应用 {package_name} 在设备 {device_id} 上的详细内存信息 =====\n")
         f.write(f"采集时间: {timestamp}\n\n")
-        f.write(result.stdout)
+        f.write(output)
     
     print(f"详细内存信息已保存到 {meminfo_file}")
     return str(meminfo_file)
 
-def get_cpu_info(device_id, package_name):
+def get_cpu_info(shell, package_name):
     """获取应用CPU使用情况"""
-    result = subprocess.run(
-        ['adb', '-s', device_id, 'shell', 'dumpsys', 'cpuinfo', '|', 'grep', package_name],
-        capture_output=True, text=True, shell=True
-    )
-    
-    output = result.stdout
+    # 直接获取完整的cpuinfo并在本地按包名过滤，避免额外的grep进程
+    output = shell.run('dumpsys cpuinfo')
     
     # 解析CPU信息
-    cpu_data = {}
+    cpu_data = {'cpu_percentage': 0.0}
     
     # 提取CPU使用百分比
-    cpu_match = re.search(r'(\d+(?:\.\d+)?)%', output)
-    if cpu_match:
-        cpu_data['cpu_percentage'] = float(cpu_match.group(1))
-    else:
-        cpu_data['cpu_percentage'] = 0.0
+    for line in output.splitlines():
+        if package_name in line:
+            cpu_match = re.search(r'(\d+(?:\.\d+)?)%', line)
+            if cpu_match:
+                cpu_data['cpu_percentage'] = float(cpu_match.group(1))
+                break
     
     return cpu_data
 
-def get_fps_info(device_id, package_name):
-    """获取应用FPS信息"""
-    # 清除之前的图形信息
-    subprocess.run(
-        ['adb', '-s', device_id, 'shell', 'dumpsys', 'gfxinfo', package_name, 'reset'],
-        capture_output=True
-    )
-    
-    # 等待一段时间收集数据
-    time.sleep(1)
-    
-    # 获取图形信息
-    result = subprocess.run(
-        ['adb', '-s', device_id, 'shell', 'dumpsys', 'gfxinfo', package_name],
-        capture_output=True, text=True
-    )
-    
-    output = result.stdout
+def reset_fps_info(shell, package_name):
+    """清除应用已累计的图形信息"""
+    shell.run(f'dumpsys gfxinfo {package_name} reset')
+
+def get_fps_info(shell, package_name):
+    """获取应用FPS信息（自上次reset以来的累计值）"""
+    output = shell.run(f'dumpsys gfxinfo {package_name}')
     
     # 解析FPS信息
     fps_data = {}
@@ -230,14 +252,9 @@ def get_fps_info(device_id, package_name):
     
     return fps_data
 
-def get_battery_info(device_id):
+def get_battery_info(shell):
     """获取电池信息"""
-    result = subprocess.run(
-        ['adb', '-s', device_id, 'shell', 'dumpsys', 'battery'],
-        capture_output=True, text=True
-    )
-    
-    output = result.stdout
+    output = shell.run('dumpsys battery')
     
     # 解析电池信息
     battery_data = {}
@@ -255,8 +272,12 @@ def get_battery_info(device_id):
     
     return battery_data
 
-def collect_performance_data(device_id, package_name, duration, interval=5, result_dir=None):
-    """收集性能数据"""
+# 每采集多少次刷新一次CSV文件
+CSV_FLUSH_EVERY = 10
+
+def collect_performance_data(shell, package_name, duration, interval=5, result_dir=None, device_model=None):
+    """收集性能数据，device_model为预先获取的设备型号，不提供时在此查询"""
+    device_id = shell.device_id
     print(f"开始收集应用 {package_name} 在设备 {device_id} 上的性能数据，持续 {duration} 秒，间隔 {interval} 秒")
     
     # 使用指定的结果目录或创建新的目录
@@ -264,7 +285,9 @@ def collect_performance_data(device_id, package_name, duration, interval=5, resu
         results_dir = Path(result_dir)
     else:
         # 使用设备型号和时间戳创建更有意义的目录名
-        device_model = run_adb_command('shell getprop ro.product.model', device_id).replace(' ', '_')
+        if device_model is None:
+            device_model = shell.run('getprop ro.product.model')
+        device_model = device_model.replace(' ', '_')
         timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
         results_dir = Path(f"{device_model}_{timestamp}")
         results_dir.mkdir(exist_ok=True)
@@ -279,65 +302,88 @@ def collect_performance_data(device_id, package_name, duration, interval=5, resu
         print(f"创建详细内存信息目录: {meminfo_dir}")
         os.makedirs(meminfo_dir, exist_ok=True)
     
-    with open(csv_file, 'w', newline='') as f:
+    # 使用较大的写缓冲区，按CSV_FLUSH_EVERY次采样批量刷新
+    with open(csv_file, 'w', newline='', buffering=1 << 16) as f:
         fieldnames = ['timestamp', 'memory_total', 'memory_java_heap', 'memory_native_heap', 'memory_pss_total', 
                      'cpu_percentage', 'total_frames', 'janky_frames', 'janky_percent', 'battery_level', 'battery_temperature']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
         
-        start_time = time.time()
-        end_time = start_time + duration
+        # 使用单调时钟计算截止时间，避免adb卡顿导致采样间隔累积漂移
+        stop_event = threading.Event()
+        previous_handler = signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+        deadline = time.monotonic() + duration
+        next_tick = time.monotonic()
         
-        while time.time() < end_time:
-            current_time = time.time()
-            timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            
-            # 收集各项性能数据
-            memory_data = get_memory_info(device_id, package_name)
-            cpu_data = get_cpu_info(device_id, package_name)
-            fps_data = get_fps_info(device_id, package_name)
-            battery_data = get_battery_info(device_id)
-            
-            # 保存详细内存信息
-            try:
-                save_detailed_memory_info(device_id, package_name, timestamp, meminfo_dir)
-            except Exception as e:
-                print(f"保存详细内存信息时出错: {str(e)}")
-                # 确保目录存在
-                os.makedirs(meminfo_dir, exist_ok=True)
-                # 重试一次
-                save_detailed_memory_info(device_id, package_name, timestamp, meminfo_dir)
-            
-            # 写入CSV
-            row_data = {
-                'timestamp': timestamp,
-                'memory_total': memory_data.get('total', 0),
-                'memory_java_heap': memory_data.get('java_heap', 0),
-                'memory_native_heap': memory_data.get('native_heap', 0),
-                'memory_pss_total': memory_data.get('pss_total', 0),
-                'cpu_percentage': cpu_data.get('cpu_percentage', 0),
-                'total_frames': fps_data.get('total_frames', 0),
-                'janky_frames': fps_data.get('janky_frames', 0),
-                'janky_percent': fps_data.get('janky_percent', 0),
-                'battery_level': battery_data.get('level', 0),
-                'battery_temperature': battery_data.get('temperature', 0)
-            }
-            
-            writer.writerow(row_data)
-            f.flush()  # 确保数据立即写入文件
-            
-            # 打印当前状态
-            print(f"[{timestamp}] 内存: {memory_data.get('total', 0)/1024:.2f} MB, "
-                  f"CPU: {cpu_data.get('cpu_percentage', 0):.1f}%, "
-                  f"卡顿帧: {fps_data.get('janky_percent', 0):.1f}%, "
-                  f"电池: {battery_data.get('level', 0)}%, "
-                  f"温度: {battery_data.get('temperature', 0):.1f}°C")
-            
-            # 计算下一次收集时间
-            next_time = current_time + interval
-            sleep_time = max(0, next_time - time.time())
-            if sleep_time > 0:
-                time.sleep(sleep_time)
+        # 只在开始时重置一次图形信息，之后每次读取累计值并计算区间增量
+        reset_fps_info(shell, package_name)
+        gfx_prev = {'total': 0, 'janky': 0}
+        sample_count = 0
+        
+        try:
+            while time.monotonic() < deadline and not stop_event.is_set():
+                timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                
+                # 收集各项性能数据
+                memory_data = get_memory_info(shell, package_name)
+                cpu_data = get_cpu_info(shell, package_name)
+                fps_data = get_fps_info(shell, package_name)
+                if fps_data['total_frames'] < gfx_prev['total']:
+                    # 计数器回退（如应用重启），重新开始计算增量
+                    gfx_prev = {'total': 0, 'janky': 0}
+                total_delta = fps_data['total_frames'] - gfx_prev['total']
+                janky_delta = max(0, fps_data['janky_frames'] - gfx_prev['janky'])
+                gfx_prev = {'total': fps_data['total_frames'], 'janky': fps_data['janky_frames']}
+                fps_data = {
+                    'total_frames': total_delta,
+                    'janky_frames': janky_delta,
+                    'janky_percent': round(janky_delta * 100.0 / total_delta, 2) if total_delta > 0 else 0.0
+                }
+                battery_data = get_battery_info(shell)
+                
+                # 保存详细内存信息
+                try:
+                    save_detailed_memory_info(shell, package_name, timestamp, meminfo_dir)
+                except Exception as e:
+                    print(f"保存详细内存信息时出错: {str(e)}")
+                    # 确保目录存在
+                    os.makedirs(meminfo_dir, exist_ok=True)
+                    # 重试一次
+                    save_detailed_memory_info(shell, package_name, timestamp, meminfo_dir)
+                
+                # 写入CSV，列顺序与fieldnames一致
+                writer.writerow([
+                    timestamp,
+                    memory_data.get('total', 0),
+                    memory_data.get('java_heap', 0),
+                    memory_data.get('native_heap', 0),
+                    memory_data.get('pss_total', 0),
+                    cpu_data.get('cpu_percentage', 0),
+                    fps_data.get('total_frames', 0),
+                    fps_data.get('janky_frames', 0),
+                    fps_data.get('janky_percent', 0),
+                    battery_data.get('level', 0),
+                    battery_data.get('temperature', 0)
+                ])
+                sample_count += 1
+                if sample_count % CSV_FLUSH_EVERY == 0:
+                    f.flush()
+                
+                # 打印当前状态
+                print(f"[{timestamp}] 内存: {memory_data.get('total', 0)/1024:.2f} MB, "
+                      f"CPU: {cpu_data.get('cpu_percentage', 0):.1f}%, "
+                      f"卡顿帧: {fps_data.get('janky_percent', 0):.1f}%, "
+                      f"电池: {battery_data.get('level', 0)}%, "
+                      f"温度: {battery_data.get('temperature', 0):.1f}°C")
+                
+                # 计算下一次收集时间，可被Ctrl-C提前唤醒
+                next_tick += interval
+                stop_event.wait(max(0, next_tick - time.monotonic()))
+        finally:
+            signal.signal(signal.SIGINT, previous_handler)
+        
+        if stop_event.is_set():
+            print("收到中断信号，提前结束性能数据收集")
     
     print(f"性能数据收集完成，结果保存在 {csv_file}")
     print(f"详细内存信息保存在 {meminfo_dir} 目录下")
@@ -452,6 +498,34 @@ def generate_performance_report(csv_file):
     print(f"性能报告已生成: {report_file}")
     return report_file
 
+def _run_one(device_id, package_name, duration, interval):
+    """对单个设备执行启动应用、收集数据和生成报告的完整流程"""
+    # 每个设备复用同一个adb shell会话
+    with AdbShell(device_id) as shell:
+        # 安装检查、主Activity解析（结果被缓存供launch_app使用）和设备型号查询合并为一次shell往返
+        installed, device_model = _prepare_device(shell, package_name)
+        
+        # 检查应用是否已安装
+        if not installed:
+            print(f"错误：应用 {package_name} 未在设备 {device_id} 上安装")
+            return None
+        
+        # 启动应用
+        if not launch_app(shell, package_name):
+            print(f"错误：无法在设备 {device_id} 上启动应用 {package_name}")
+            return None
+        
+        # 等待应用完全启动
+        print("等待应用完全启动...")
+        time.sleep(3)
+        
+        # 收集性能数据
+        csv_file = collect_performance_data(shell, package_name, duration, interval,
+                                            device_model=device_model or None)
+    
+    # 生成性能报告
+    return generate_performance_report(csv_file)
+
 def main():
     parser = argparse.ArgumentParser(description='应用性能分析工具')
     parser.add_argument('--package', '-p', help='应用包名，如不提供则尝试从auto_install.py获取')
@@ -490,27 +564,9 @@ def main():
     for device_id in devices:
         print(f"\n处理设备：{device_id}")
         
-        # 检查应用是否已安装
-        if not is_app_installed(device_id, package_name):
-            print(f"错误：应用 {package_name} 未在设备 {device_id} 上安装")
-            continue
-        
-        # 启动应用
-        if not launch_app(device_id, package_name):
-            print(f"错误：无法在设备 {device_id} 上启动应用 {package_name}")
-            continue
-        
-        # 等待应用完全启动
-        print("等待应用完全启动...")
-        time.sleep(3)
-        
-        # 收集性能数据
-        csv_file = collect_performance_data(device_id, package_name, args.duration, args.interval)
-        
-        # 生成性能报告
-        report_file = generate_performance_report(csv_file)
-        
-        print(f"设备 {device_id} 的性能分析完成，报告保存在 {report_file}")
+        report_file = _run_one(device_id, package_name, args.duration, args.interval)
+        if report_file:
+            print(f"设备 {device_id} 的性能分析完成，报告保存在 {report_file}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,11 +1,26 @@
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, request, stream_with_context
 import os
 import json
 from pathlib import Path
-from data_processor import DataProcessor
+from data_processor import DataProcessor, parse_timestamp
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 
+def dumps_json(data):
+    """序列化为UTF-8编码的JSON字节串，优先使用orjson以加快大量性能数据的编码"""
+    if orjson is None:
+        return json.dumps(data, ensure_ascii=False).encode('utf-8')
+    return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+def json_response(data, status=200):
+    """构造JSON响应"""
+    return app.response_class(dumps_json(data), status=status, mimetype='application/json')
+
 # 初始化数据处理器
 base_dir = Path(os.path.dirname(os.path.abspath(__file__))).parent
 data_processor = DataProcessor(base_dir)
@@ -30,7 +45,7 @@ def get_devices():
             'folder_name': data['folder_name']
         })
     
-    return jsonify(devices)
+    return json_response(devices)
 
 @app.route('/api/device/<folder_name>/info')
 def get_device_info(folder_name):
@@ -39,15 +54,15 @@ def get_device_info(folder_name):
     device_info = data_processor.get_device_info(device_folder)
     
     if not device_info:
-        return jsonify({'error': '设备信息不存在'}), 404
+        return json_response({'error': '设备信息不存在'}, 404)
     
-    return jsonify(device_info)
+    return json_response(device_info)
 
 @app.route('/api/device/<folder_name>/performance')
 def get_device_performance(folder_name):
-    """获取指定设备的性能数据"""
+    """获取指定设备的性能数据，以NDJSON流的形式逐行返回"""
     device_folder = base_dir / folder_name
-    performance_data = data_processor.get_performance_data(device_folder)
+    performance_data = data_processor.iter_performance_data(device_folder)
     
     # 获取查询参数
     start_time = request.args.get('start_time')
@@ -55,12 +70,15 @@ def get_device_performance(folder_name):
     
     # 如果有时间范围参数，过滤数据
     if start_time and end_time:
-        from datetime import datetime
-        start = datetime.strptime(start_time, '%Y-%m-%d %H:%M:%S')
-        end = datetime.strptime(end_time, '%Y-%m-%d %H:%M:%S')
-        performance_data = data_processor.filter_data_by_time(performance_data, start, end)
+        start = parse_timestamp(start_time)
+        end = parse_timestamp(end_time)
+        performance_data = data_processor.iter_data_by_time(performance_data, start, end)
+    
+    def generate():
+        for row in performance_data:
+            yield dumps_json(row) + b'\n'
     
-    return jsonify(performance_data)
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 @app.route('/api/metrics')
 def get_metrics():
@@ -78,7 +96,7 @@ def get_metrics():
         {'id': 'battery_temperature', 'name': '电池温度 (°C)', 'category': '电池'}
     ]
     
-    return jsonify(metrics)
+    return json_response(metrics)
 
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5002)
\ No newline at end of file
@@ -5,6 +5,16 @@ import re
 from datetime import datetime
 from pathlib import Path
 
+# 设备测试数据目录名格式：<设备名>_<YYYYMMDD>_<HHMMSS>
+DEVICE_FOLDER_PATTERN = re.compile(r'.*_\d{8}_\d{6}$')
+
+def parse_timestamp(timestamp):
+    """
+    解析'%Y-%m-%d %H:%M:%S'格式的时间戳
+    fromisoformat由C实现，比strptime快一个数量级
+    """
+    return datetime.fromisoformat(timestamp)
+
 class DataProcessor:
     def __init__(self, base_dir):
         """
@@ -19,11 +29,10 @@ class DataProcessor:
         获取所有设备文件夹
         :return: 设备文件夹列表
         """
-        device_folders = []
-        for item in self.base_dir.iterdir():
-            if item.is_dir() and re.match(r'.*_\d{8}_\d{6}$', item.name):
-                device_folders.append(item)
-        return device_folders
+        # os.scandir返回的目录项自带文件类型信息，无需对每一项再stat
+        with os.scandir(self.base_dir) as entries:
+            return [Path(entry.path) for entry in entries
+                    if entry.is_dir(follow_symlinks=False) and DEVICE_FOLDER_PATTERN.match(entry.name)]
     
     def get_device_info(self, device_folder):
         """
@@ -45,11 +54,18 @@ class DataProcessor:
         :param device_folder: 设备文件夹路径
         :return: 性能数据列表
         """
+        return list(self.iter_performance_data(device_folder))
+    
+    def iter_performance_data(self, device_folder):
+        """
+        逐行读取性能数据，避免一次性加载整个CSV
+        :param device_folder: 设备文件夹路径
+        :return: 性能数据记录的生成器
+        """
         performance_files = list(device_folder.glob('*_performance.csv'))
         if not performance_files:
-            return []
+            return
         
-        performance_data = []
         with open(performance_files[0], 'r') as f:
             reader = csv.DictReader(f)
             for row in reader:
@@ -61,8 +77,7 @@ class DataProcessor:
                         row[key] = float(row[key])
                     except ValueError:
                         pass
-                performance_data.append(row)
-        return performance_data
+                yield row
     
     def get_all_devices_data(self):
         """
@@ -96,8 +111,8 @@ class DataProcessor:
             return None, None
         
         performance = device_data['performance']
-        start_time = datetime.strptime(performance[0]['timestamp'], '%Y-%m-%d %H:%M:%S')
-        end_time = datetime.strptime(performance[-1]['timestamp'], '%Y-%m-%d %H:%M:%S')
+        start_time = parse_timestamp(performance[0]['timestamp'])
+        end_time = parse_timestamp(performance[-1]['timestamp'])
         
         return start_time, end_time
     
@@ -109,10 +124,17 @@ class DataProcessor:
         :param end_time: 结束时间
         :return: 过滤后的性能数据列表
         """
-        filtered_data = []
+        return list(self.iter_data_by_time(performance_data, start_time, end_time))
+    
+    def iter_data_by_time(self, performance_data, start_time, end_time):
+        """
+        按时间范围逐条过滤性能数据
+        :param performance_data: 性能数据的可迭代对象
+        :param start_time: 开始时间
+        :param end_time: 结束时间
+        :return: 过滤后的性能数据生成器
+        """
         for data in performance_data:
-            data_time = datetime.strptime(data['timestamp'], '%Y-%m-%d %H:%M:%S')
+            data_time = parse_timestamp(data['timestamp'])
             if start_time <= data_time <= end_time:
-                filtered_data.append(data)
-        
-        return filtered_data
\ No newline at end of file
+                yield data
\ No newline at end of file
@@ -349,7 +349,12 @@ function applyFilters() {
                 url: `/api/device/${deviceFolder}/performance`,
                 method: 'GET',
                 data: params,
-                success: function(performanceData) {
+                dataType: 'text',
+                success: function(body) {
+                    // 性能数据以NDJSON格式返回，每行一条记录
+                    const performanceData = body.split('\n')
+                        .filter(line => line.trim())
+                        .map(line => JSON.parse(line));
                     resolve({
                         deviceFolder: deviceFolder,
                         data: performanceData
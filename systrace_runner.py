@@ -0,0 +1,51 @@
+"""systrace.py support for test_trace.py.
+
+Kept separate so the deprecated systrace path (and its imports) is only loaded when '--tool systrace' is used.
+"""
+import os
+import sys
+import functools
+import logging
+
+logger = logging.getLogger('trace')
+
+# Android SDK roots from the environment, resolved once at import
+_ANDROID_SDK_ROOTS = tuple(filter(None, (os.environ.get('ANDROID_HOME'), os.environ.get('ANDROID_SDK_ROOT'))))
+
+@functools.lru_cache(maxsize=4)
+def find_systrace_script(systrace_path_hint=None):
+    """Tries to find systrace.py. Results are cached per hint."""
+    # 1. Use provided hint
+    if systrace_path_hint and os.path.isfile(systrace_path_hint) and systrace_path_hint.endswith('systrace.py'):
+        logger.info("Using provided systrace path: %s", systrace_path_hint)
+        return systrace_path_hint
+
+    # 2. Check common locations (Android SDK platform-tools)
+    for sdk_root in _ANDROID_SDK_ROOTS:
+        potential_path = os.path.join(sdk_root, 'platform-tools', 'systrace', 'systrace.py')
+        if os.path.isfile(potential_path):
+            logger.info("Found systrace.py in SDK: %s", potential_path)
+            return potential_path
+
+    # 3. Check system PATH (less common for systrace.py)
+    import shutil
+    systrace_in_path = shutil.which('systrace.py')
+    if systrace_in_path:
+         logger.info("Found systrace.py in PATH: %s", systrace_in_path)
+         return systrace_in_path
+
+    logger.error("Could not automatically find systrace.py. Please install Android SDK Platform-Tools and ensure "
+                 "ANDROID_HOME is set, or provide the path using the --systrace-path argument.")
+    return None
+
+def build_systrace_cmd(package_name, duration_s, output_file, systrace_script_path, categories):
+    """Builds the systrace.py command line ('app' category is dropped when no package is traced)."""
+    # Note: systrace.py is often Python 2, but recent versions might support Python 3.
+    # Use the same python running this script.
+    return [
+        sys.executable, systrace_script_path,
+        '--time', str(duration_s),
+        '-o', output_file,
+        *(['-a', package_name] if package_name else []), # Trace specific app
+        *(c for c in categories if package_name or c != 'app'),
+    ]
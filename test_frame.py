@@ -19,7 +19,12 @@ python test_frame.py --apk-dir <APK目录> --activity <主活动名> --duration
 
 import subprocess
 import os
-import glob
+import io
+import contextlib
+import array
+import hashlib
+import functools
+import shutil
 import time
 import re
 import json
@@ -30,49 +35,66 @@ from datetime import datetime
 from pathlib import Path
 import argparse
 import threading
+import sys
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import numpy as np
 from concurrent.futures import ThreadPoolExecutor
+from adb_shell import AdbShell
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# gfxinfo / framestats / SurfaceFlinger输出解析用的正则，在模块加载时预编译
+# gfxinfo输出为ASCII且可能很大，直接以bytes解析，只对提取出的少量字段解码
+_RE_TOTAL = re.compile(rb'Total frames rendered: (\d+)')
+_RE_JANKY = re.compile(rb'Janky frames: (\d+) \((\d+\.\d+)%\)')
+_RE_HIST_ROW = re.compile(rb'\s+(\d+)ms=(\d+)')
+_RE_FRAMETIME_MS = re.compile(rb'\s+(\d+\.\d+)ms')
+_RE_FRAMESTATS_ROW = re.compile(rb'\s*(\d+),\s*(\d+),\s*(\d+)')
+_RE_SF_LATENCY_ROW = re.compile(r'\s*\d+')
 
 def get_latest_apk(directory):
     """获取指定目录下最新的APK文件"""
-    apk_files = glob.glob(os.path.join(directory, '*.apk'))
-    if not apk_files:
+    # 单次scandir遍历，每个文件只stat一次
+    try:
+        with os.scandir(directory) as entries:
+            latest = max((entry for entry in entries if entry.name.endswith('.apk') and entry.is_file()),
+                         key=lambda entry: entry.stat().st_mtime, default=None)
+    except OSError:
         return None
-    return max(apk_files, key=os.path.getmtime)
+    return latest.path if latest else None
 
 def run_adb_command(command, device_id=None):
-    """执行adb命令并返回结果"""
-    # 检查系统类型，确保ADB命令能在不同平台正确执行
-    system_type = get_system_type()
+    """执行adb命令并返回结果（不经过本地shell，需要过滤输出时在Python中处理）"""
+    cmd = ['adb']
+    if device_id:
+        cmd.extend(['-s', device_id])
+    cmd.extend(command.split())
     
-    # 构建基本命令
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        return result.stdout.strip() if result.returncode == 0 else ""
+    except Exception as e:
+        print(f"执行命令失败: {' '.join(cmd)}\n错误信息: {str(e)}")
+        return ""
+
+def run_adb_shell(script, device_id=None):
+    """通过一次adb shell调用在设备上执行多条以;分隔的命令，返回未裁剪的输出"""
     cmd = ['adb']
     if device_id:
         cmd.extend(['-s', device_id])
+    cmd.extend(['shell', script])
     
-    if '|' in command:
-        # 对于包含管道的命令，需要使用shell=True
-        if system_type == 'windows':
-            # Windows下可能需要使用cmd /c
-            full_cmd = ' '.join(cmd) + ' ' + command
-        else:
-            # Mac和Linux可以直接使用管道
-            full_cmd = ' '.join(cmd) + ' ' + command
-            
-        try:
-            result = subprocess.run(full_cmd, shell=True, capture_output=True, text=True)
-            return result.stdout.strip() if result.returncode == 0 else ""
-        except Exception as e:
-            print(f"执行命令失败: {full_cmd}\n错误信息: {str(e)}")
-            return ""
-    else:
-        # 对于不包含管道的简单命令
-        cmd.extend(command.split())
-        try:
-            result = subprocess.run(cmd, capture_output=True, text=True)
-            return result.stdout.strip() if result.returncode == 0 else ""
-        except Exception as e:
-            print(f"执行命令失败: {' '.join(cmd)}\n错误信息: {str(e)}")
-            return ""
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        return result.stdout
+    except Exception as e:
+        print(f"执行命令失败: {' '.join(cmd)}\n错误信息: {str(e)}")
+        return ""
 
 def get_connected_devices():
     """获取所有已连接的设备ID"""
@@ -106,10 +128,13 @@ def get_device_info(device_id):
             'model': {}
         }
         
-        # 获取设备型号信息
-        manufacturer = run_adb_command('shell getprop ro.product.manufacturer', device_id)
-        model = run_adb_command('shell getprop ro.product.model', device_id)
-        brand = run_adb_command('shell getprop ro.product.brand', device_id)
+        # 一次adb调用同时获取设备型号信息和屏幕信息，前三行依次为厂商、型号、品牌
+        output = run_adb_shell(
+            'getprop ro.product.manufacturer; getprop ro.product.model; getprop ro.product.brand; dumpsys display',
+            device_id
+        )
+        lines = output.splitlines()
+        manufacturer, model, brand = [line.strip() for line in (lines[:3] + ['', '', ''])[:3]]
         
         info['model']['manufacturer'] = manufacturer
         info['model']['model'] = model
@@ -117,7 +142,7 @@ def get_device_info(device_id):
         info['model']['full_name'] = f"{brand}_{model}"
         
         # 获取设备屏幕刷新率
-        refresh_output = run_adb_command('shell dumpsys display | grep "mDisplayInfo"', device_id)
+        refresh_output = '\n'.join(line for line in lines[3:] if 'mDisplayInfo' in line)
         refresh_match = re.search(r'fps=(\d+\.?\d*)', refresh_output)
         if refresh_match:
             info['model']['refresh_rate'] = float(refresh_match.group(1))
@@ -129,8 +154,9 @@ def get_device_info(device_id):
         print(f"获取设备信息失败: {str(e)}")
         return None
 
+@functools.lru_cache(maxsize=None)
 def get_system_type():
-    """获取当前系统类型"""
+    """获取当前系统类型（运行期间不会变化，只计算一次）"""
     system = platform.system().lower()
     if system == 'darwin':
         return 'mac'
@@ -141,47 +167,90 @@ def get_system_type():
     else:
         return 'unknown'
 
+@functools.lru_cache(maxsize=None)
+def _find_aapt():
+    """查找aapt工具路径，只在首次调用时扫描文件系统"""
+    aapt_path = shutil.which('aapt')
+    if aapt_path:
+        return aapt_path
+    
+    if get_system_type() != 'mac':
+        # 其他系统直接尝试使用aapt
+        return 'aapt'
+    
+    # 在Mac上，aapt可能在Android SDK的build-tools目录下
+    android_home = os.environ.get('ANDROID_HOME') or os.environ.get('ANDROID_SDK_ROOT')
+    if not android_home:
+        print("错误：未设置ANDROID_HOME或ANDROID_SDK_ROOT环境变量")
+        return None
+    
+    # 查找最新的build-tools版本
+    build_tools_dir = os.path.join(android_home, 'build-tools')
+    if not os.path.exists(build_tools_dir):
+        print(f"错误：未找到build-tools目录 {build_tools_dir}")
+        return None
+    
+    versions = os.listdir(build_tools_dir)
+    if not versions:
+        print(f"错误：在 {build_tools_dir} 未找到build-tools版本")
+        return None
+    
+    latest_version = sorted(versions)[-1]
+    aapt_path = os.path.join(build_tools_dir, latest_version, 'aapt')
+    if not os.path.exists(aapt_path):
+        print(f"错误：在 {aapt_path} 未找到aapt工具")
+        return None
+    return os.path.abspath(aapt_path)
+
+# 包名的磁盘缓存：{APK指纹: 包名}，同一个APK重复测试时无需再调用aapt
+PACKAGE_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.testauto_cache.json')
+_PKG_CACHE = None
+
+def _apk_fingerprint(apk_path):
+    """以APK前64KiB内容、文件大小和修改时间计算指纹，避免对整个大文件做哈希"""
+    stat = os.stat(apk_path)
+    digest = hashlib.sha256()
+    with open(apk_path, 'rb') as f:
+        digest.update(f.read(64 * 1024))
+    digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+def _load_package_cache():
+    """首次使用时从磁盘加载包名缓存，文件不存在或损坏时从空缓存开始"""
+    global _PKG_CACHE
+    if _PKG_CACHE is None:
+        try:
+            with open(PACKAGE_CACHE_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            _PKG_CACHE = data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            _PKG_CACHE = {}
+    return _PKG_CACHE
+
+def _save_package_cache():
+    """先写临时文件再替换，避免中断时留下不完整的缓存文件"""
+    tmp_file = PACKAGE_CACHE_FILE + '.tmp'
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(_PKG_CACHE, f, ensure_ascii=False)
+        os.replace(tmp_file, PACKAGE_CACHE_FILE)
+    except OSError as e:
+        print(f"警告：无法写入包名缓存 {PACKAGE_CACHE_FILE}：{str(e)}")
+
 def get_package_name(apk_path):
     """从APK文件中提取package name"""
     try:
-        system_type = get_system_type()
+        cache = _load_package_cache()
+        cache_key = _apk_fingerprint(apk_path)
+        if cache_key in cache:
+            return cache[cache_key]
         
-        if system_type == 'mac':
-            # 在Mac上，aapt可能在Android SDK的build-tools目录下
-            # 尝试使用环境变量中的aapt或指定路径的aapt
-            try:
-                result = subprocess.run(['aapt', 'dump', 'badging', apk_path], 
-                                      capture_output=True, text=True)
-            except FileNotFoundError:
-                # 如果直接调用失败，尝试查找Android SDK路径
-                android_home = os.environ.get('ANDROID_HOME') or os.environ.get('ANDROID_SDK_ROOT')
-                if android_home:
-                    # 查找最新的build-tools版本
-                    build_tools_dir = os.path.join(android_home, 'build-tools')
-                    if os.path.exists(build_tools_dir):
-                        versions = os.listdir(build_tools_dir)
-                        if versions:
-                            latest_version = sorted(versions)[-1]
-                            aapt_path = os.path.join(build_tools_dir, latest_version, 'aapt')
-                            if os.path.exists(aapt_path):
-                                result = subprocess.run([aapt_path, 'dump', 'badging', apk_path], 
-                                                      capture_output=True, text=True)
-                            else:
-                                print(f"错误：在 {aapt_path} 未找到aapt工具")
-                                return None
-                        else:
-                            print(f"错误：在 {build_tools_dir} 未找到build-tools版本")
-                            return None
-                    else:
-                        print(f"错误：未找到build-tools目录 {build_tools_dir}")
-                        return None
-                else:
-                    print("错误：未设置ANDROID_HOME或ANDROID_SDK_ROOT环境变量")
-                    return None
-        else:
-            # 其他系统直接尝试使用aapt
-            result = subprocess.run(['aapt', 'dump', 'badging', apk_path], 
-                                  capture_output=True, text=True)
+        aapt_path = _find_aapt()
+        if not aapt_path:
+            return None
+        
+        result = subprocess.run([aapt_path, 'dump', 'badging', apk_path], 
+                              capture_output=True, text=True)
         
         if result.returncode != 0:
             print(f"错误：获取APK信息失败：{result.stderr}")
@@ -189,7 +258,10 @@ def get_package_name(apk_path):
         
         for line in result.stdout.split('\n'):
             if line.startswith('package: name='):
-                return line.split("'")[1]
+                package_name = line.split("'")[1]
+                cache[cache_key] = package_name
+                _save_package_cache()
+                return package_name
         return None
     except Exception as e:
         print(f"错误：解析APK信息时发生异常：{str(e)}")
@@ -206,181 +278,382 @@ def install_apk(device_id, apk_path, package_name):
     result = run_adb_command(f"install -r -t {apk_path}", device_id)
     return "Success" in result
 
-def collect_fps_data(device_id, package_name, duration=60, interval=1):
-    """收集指定设备上的帧率数据"""
-    results = []
-    fps_values = []
+# 开启/关闭帧率统计所需的设备命令，以;连接后一次发送
+PROFILING_ENABLE_COMMANDS = "; ".join([
+    "setprop debug.hwui.profile true",
+    "setprop debug.hwui.renderer.profile true",
+    "setprop debug.egl.trace 1",
+    "service call SurfaceFlinger 1008 i32 1",  # 启用帧率统计
+])
+PROFILING_DISABLE_COMMANDS = "; ".join([
+    "setprop debug.hwui.profile false",
+    "setprop debug.hwui.renderer.profile false",
+    "setprop debug.egl.trace 0",
+    "service call SurfaceFlinger 1008 i32 0",  # 关闭帧率统计
+])
+
+class RunningStats:
+    """在采集过程中在线累计样本数、均值、方差（Welford算法）和最值，避免结束后多次遍历"""
+    
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+    
+    def add(self, value):
+        self.n += 1
+        delta = value - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+    
+    def extend(self, values):
+        """批量合并一组样本（Chan等人的并行方差合并公式），结果与逐个add一致"""
+        values = np.asarray(values, dtype=np.float64)
+        if not values.size:
+            return
+        count = values.size
+        batch_mean = float(values.mean())
+        batch_m2 = float(((values - batch_mean) ** 2).sum())
+        total = self.n + count
+        delta = batch_mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += batch_m2 + delta * delta * self.n * count / total
+        self.n = total
+        batch_min, batch_max = float(values.min()), float(values.max())
+        if self.min is None or batch_min < self.min:
+            self.min = batch_min
+        if self.max is None or batch_max > self.max:
+            self.max = batch_max
+    
+    @property
+    def stdev(self):
+        """样本标准差，与statistics.stdev一致；样本数不足2时返回0"""
+        return (self.m2 / (self.n - 1)) ** 0.5 if self.n > 1 else 0
+
+class FrameTimeHistogram:
+    """按列式结构保存每次迭代的帧时间分布：桶（毫秒数）只存一份，计数存放在(迭代数, 桶数)的int32二维数组中，
+    导出JSON时才还原为字典"""
+    
+    def __init__(self, expected_rows):
+        self.edges = []
+        # {桶毫秒数: 列号}，按桶首次出现的顺序分配，同一设备的桶集合是固定的
+        self._index = {}
+        self._filled = set()
+        # 当前缓冲区是否记录过桶：已知桶后new_row返回全零缓冲区，不能靠缓冲区是否为空判断有无数据
+        self._row_recorded = False
+        self.counts = np.zeros((max(1, expected_rows), 0), dtype=np.int32)
+    
+    def new_row(self):
+        """按已知的桶数分配一次迭代的计数缓冲区"""
+        self._row_recorded = False
+        return array.array('i', [0]) * len(self.edges)
+    
+    def record(self, buf, time_ms, count):
+        """把一个桶的计数直接写入缓冲区，遇到新的桶时分配列号并加长缓冲区"""
+        col = self._index.get(time_ms)
+        if col is None:
+            col = self._index[time_ms] = len(self.edges)
+            self.edges.append(time_ms)
+        if col >= len(buf):
+            buf.extend([0] * (col + 1 - len(buf)))
+        buf[col] = count
+        self._row_recorded = True
+    
+    def set_row(self, row, buf):
+        """将第row次迭代的计数缓冲区整行写入矩阵，必要时扩展行和列；该次迭代没有帧时间分布时不写入"""
+        if not self._row_recorded:
+            return
+        if len(buf) > self.counts.shape[1]:
+            extra = np.zeros((self.counts.shape[0], len(buf) - self.counts.shape[1]), dtype=np.int32)
+            self.counts = np.hstack([self.counts, extra])
+        if row >= self.counts.shape[0]:
+            extra = np.zeros((max(row + 1, self.counts.shape[0] * 2) - self.counts.shape[0],
+                              self.counts.shape[1]), dtype=np.int32)
+            self.counts = np.vstack([self.counts, extra])
+        self.counts[row, :len(buf)] = np.frombuffer(buf, dtype=np.int32)
+        self._filled.add(row)
+    
+    def row_dict(self, row):
+        """将第row次迭代的计数还原为{"桶毫秒数": 帧数}字典，没有数据时返回空字典"""
+        if row not in self._filled:
+            return {}
+        return {str(edge): count for edge, count in zip(self.edges, self.counts[row].tolist())}
+
+def parse_framestats_ms(rows):
+    """将framestats数据行一次性解析为毫秒数组：第3列为纳秒，整体乘以1e-6换算"""
+    if not rows:
+        return np.empty(0)
+    try:
+        column = np.loadtxt(io.BytesIO(b'\n'.join(rows)), delimiter=',', usecols=(2,),
+                            dtype=np.float64, ndmin=1)
+    except ValueError:
+        # 存在第3列缺失或无法解析的行时逐行解析，跳过坏行而不是让整次采集失败
+        values = []
+        for row in rows:
+            parts = row.split(b',')
+            try:
+                values.append(float(parts[2].strip()))
+            except (ValueError, IndexError):
+                pass
+        column = np.array(values, dtype=np.float64)
+    return column * 1e-6
+
+def probe_framestats(shell, package_name):
+    """探测设备的framestats输出是否已包含汇总信息，是则每次采样只需调用一次dumpsys"""
+    output = shell.run_bytes(f"dumpsys gfxinfo {package_name} framestats")
+    return b"Total frames rendered" in output
+
+# 每次迭代的帧率输出走日志队列，由后台线程统一写到stdout，避免多个设备线程争用stdout
+logger = logging.getLogger('fps')
+
+def start_iteration_logging():
+    """为帧率日志挂上队列处理器并启动后台输出线程，返回需要在结束时stop的QueueListener"""
+    log_queue = queue.Queue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter('%(message)s'))
+    listener = QueueListener(log_queue, stream_handler)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    listener.start()
+    return listener
+
+# 设备端循环每输出一次采样后打印的分隔标记
+GFXINFO_TICK = b"__TICK__"
+
+def stream_gfxinfo(device_id, package_name, interval, count, use_framestats=False):
+    """在设备端用shell循环定时输出gfxinfo并重置，共采样count次，逐个产出每次采样的原始输出（bytes）
+    
+    整个采集过程只建立一条adb连接，Python端解析与设备端采集同时进行
+    """
+    if use_framestats:
+        # framestats输出已包含汇总信息，一次调用即可
+        dump = f"dumpsys gfxinfo {package_name} framestats"
+    else:
+        # 标准gfxinfo没有汇总信息时再补充framestats
+        dump = (f'out=$(dumpsys gfxinfo {package_name}); echo "$out"; '
+                f'case "$out" in *"Total frames rendered"*) ;; '
+                f'*) dumpsys gfxinfo {package_name} framestats;; esac')
+    # 设备端循环次数有上限：即使主机端adb被杀后adbd没有结束远端命令，循环也会自行退出，不会无限重置gfxinfo
+    script = (f"i=0; while [ $i -lt {count} ]; do sleep {interval}; {dump}; "
+              f"dumpsys gfxinfo {package_name} reset >/dev/null; echo {GFXINFO_TICK.decode()}; i=$((i+1)); done")
+    
+    # stdin置为DEVNULL，避免adb把终端的键盘输入转发给远端循环
+    proc = subprocess.Popen(['adb', '-s', device_id, 'shell', script],
+                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+    try:
+        chunk = []
+        for line in proc.stdout:
+            if line.rstrip() == GFXINFO_TICK:
+                yield b"".join(chunk)
+                chunk = []
+            else:
+                chunk.append(line)
+    finally:
+        proc.kill()
+        proc.wait()
+        proc.stdout.close()
+
+def collect_fps_data(shell, package_name, duration=60, interval=1, use_framestats=False):
+    """通过持久化的adb shell会话收集指定设备上的帧率数据
+    
+    gfxinfo采样由stream_gfxinfo在设备端循环产生；use_framestats为True时每次采样只调用
+    dumpsys gfxinfo framestats，它已包含汇总信息
+    """
+    device_id = shell.device_id
+    # 采样次数由时长和间隔确定，结果列表按次数预先分配
+    n_iter = max(1, int(duration // interval)) if interval > 0 else 1
+    results = [None] * n_iter
+    fps_values = [0.0] * n_iter
     frame_times = []
+    fps_stats = RunningStats()
+    frame_time_stats = RunningStats()
+    frame_time_hist = FrameTimeHistogram(n_iter)
     jank_count = 0
     total_frames = 0
     
     print(f"设备 {device_id} - 开始收集帧率数据，持续 {duration} 秒...")
     
     # 启用帧率统计功能
-    run_adb_command(f"shell setprop debug.hwui.profile true", device_id)
-    run_adb_command(f"shell setprop debug.hwui.renderer.profile true", device_id)
-    run_adb_command(f"shell setprop debug.egl.trace 1", device_id)
-    
-    # 启用gfxinfo统计
-    run_adb_command(f"shell service call SurfaceFlinger 1008 i32 1", device_id)  # 启用帧率统计
+    shell.run(PROFILING_ENABLE_COMMANDS)
     
     # 清除之前的图形信息
-    run_adb_command(f"shell dumpsys gfxinfo {package_name} reset", device_id)
+    shell.run(f"dumpsys gfxinfo {package_name} reset")
     
     # 收集指定时长的帧率数据
-    start_time = time.time()
     iterations = 0
     prev_total_frames = 0
     accumulated_frames = 0
     accumulated_janky = 0
-    
-    while time.time() - start_time < duration:
-        # 等待指定的间隔时间
-        time.sleep(interval)
-        iterations += 1
-        
-        # 获取图形信息 - 尝试多种方式获取帧率数据
-        # 1. 首先尝试标准gfxinfo
-        output = run_adb_command(f"shell dumpsys gfxinfo {package_name}", device_id)
-        
-        # 2. 如果没有足够信息，尝试framestats
-        if "Total frames rendered" not in output:
-            output += run_adb_command(f"shell dumpsys gfxinfo {package_name} framestats", device_id)
-        
-        # 解析帧率信息
-        # 提取总帧数和慢帧数
-        total_frames_match = re.search(r'Total frames rendered: (\d+)', output)
-        janky_frames_match = re.search(r'Janky frames: (\d+) \((\d+\.\d+)%\)', output)
-        
-        # 尝试提取帧时间分布
-        frame_time_data = {}
-        frame_time_section = False
-        for line in output.split('\n'):
-            if 'Frame time histogram' in line:
-                frame_time_section = True
-                continue
-            if frame_time_section and re.match(r'\s+\d+ms=\d+', line.strip()):
-                parts = line.strip().split('=')
-                if len(parts) == 2:
-                    time_ms = parts[0].strip().rstrip('ms')
-                    count = parts[1].strip()
-                    frame_time_data[time_ms] = int(count)
-            elif frame_time_section and line.strip() == "":
-                frame_time_section = False
-        
-        # 提取详细的帧时间数据（如果可用）
-        detailed_frame_times = []
-        frame_times_section = False
-        for line in output.split('\n'):
-            if 'HISTOGRAM' in line or 'Framestats:' in line:
-                frame_times_section = True
-                continue
-            if frame_times_section and (re.match(r'\s+\d+\.\d+ms', line.strip()) or 
-                                        re.match(r'\s*\d+,\s*\d+,\s*\d+', line.strip())):
-                # 处理不同格式的帧时间数据
-                if 'ms' in line:
-                    time_value = float(line.strip().rstrip('ms'))
-                    detailed_frame_times.append(time_value)
-                    frame_times.append(time_value)
-                else:
-                    # 处理framestats格式的数据，通常是逗号分隔的数值
-                    parts = line.strip().split(',')
-                    if len(parts) >= 3:  # 确保有足够的数据
-                        try:
-                            # 通常第3列是VSYNC到渲染完成的时间（单位：纳秒）
-                            time_value = float(parts[2].strip()) / 1000000  # 转换为毫秒
+    # SurfaceFlinger备选方案是否可用：None表示尚未尝试，失败一次后不再重试
+    sf_fallback_works = None
+    # 无论正常结束还是异常/中断，都要关闭数据流，结束设备端的采样循环和adb子进程
+    with contextlib.closing(stream_gfxinfo(device_id, package_name, interval, n_iter, use_framestats)) as samples:
+        for i in range(n_iter):
+            # 等待设备端输出下一次采样（设备端每隔interval秒输出一次并重置图形信息）
+            output = next(samples, None)
+            if output is None:
+                logger.warning("设备 %s - 警告：gfxinfo数据流意外结束", device_id)
+                break
+            iterations = i + 1
+        
+            # 解析帧率信息
+            # 提取总帧数和慢帧数
+            total_frames_match = _RE_TOTAL.search(output)
+            janky_frames_match = _RE_JANKY.search(output)
+        
+            # 单次遍历输出，同时提取帧时间分布和详细的帧时间数据（如果可用）
+            hist_row = frame_time_hist.new_row()
+            detailed_frame_times = []
+            framestats_rows = []
+            in_histogram = False
+            in_framestats = False
+            for line in output.splitlines():
+                stripped = line.strip()
+            
+                # 帧时间分布段落
+                if b'Frame time histogram' in line:
+                    in_histogram = True
+                elif in_histogram:
+                    if _RE_HIST_ROW.match(stripped):
+                        parts = stripped.split(b'=')
+                        if len(parts) == 2:
+                            time_ms = int(parts[0].strip().rstrip(b'ms'))
+                            count = int(parts[1].strip())
+                            frame_time_hist.record(hist_row, time_ms, count)
+                    elif not stripped:
+                        in_histogram = False
+            
+                # 详细帧时间段落
+                if b'HISTOGRAM' in line or b'Framestats:' in line:
+                    in_framestats = True
+                elif in_framestats:
+                    if _RE_FRAMETIME_MS.match(stripped) or _RE_FRAMESTATS_ROW.match(stripped):
+                        # 处理不同格式的帧时间数据
+                        if b'ms' in line:
+                            time_value = float(stripped.rstrip(b'ms'))
                             detailed_frame_times.append(time_value)
                             frame_times.append(time_value)
-                        except (ValueError, IndexError):
-                            pass
-            elif frame_times_section and line.strip() == "":
-                frame_times_section = False
-        
-        # 计算当前迭代的帧率
-        current_total_frames = int(total_frames_match.group(1)) if total_frames_match else 0
-        current_janky_frames = int(janky_frames_match.group(1)) if janky_frames_match else 0
-        current_janky_percent = float(janky_frames_match.group(2)) if janky_frames_match else 0.0
-        
-        # 如果无法从dumpsys获取帧数，尝试通过详细帧时间数据计算
-        if current_total_frames == 0 and detailed_frame_times:
-            current_total_frames = len(detailed_frame_times)
-        
-        # 计算这个间隔的帧数和帧率
-        frames_in_interval = current_total_frames - prev_total_frames
-        
-        # 如果帧数计算为负数或零，可能是因为重置了计数器，尝试使用备选方法获取
-        if frames_in_interval <= 0:
-            # 尝试使用SurfaceFlinger获取帧率
-            window_name = run_adb_command(f"shell dumpsys SurfaceFlinger | grep {package_name} | head -1", device_id)
-            window_name = window_name.strip().split()[0] if window_name else ""
-            
-            if window_name:
-                # 清除之前的延迟数据
-                run_adb_command(f"shell dumpsys SurfaceFlinger --latency-clear {window_name}", device_id)
-                time.sleep(interval * 0.8)  # 等待收集数据，稍微短一点以确保在下一次迭代前完成
+                            frame_time_stats.add(time_value)
+                        else:
+                            # framestats格式的数据是逗号分隔的数值，先收集起来，遍历结束后统一解析
+                            framestats_rows.append(stripped)
+                    elif not stripped:
+                        in_framestats = False
+        
+            # 通常第3列是VSYNC到渲染完成的时间（单位：纳秒），批量换算为毫秒
+            if framestats_rows:
+                framestats_ms = parse_framestats_ms(framestats_rows)
+                frame_time_stats.extend(framestats_ms)
+                framestats_ms = framestats_ms.tolist()
+                detailed_frame_times.extend(framestats_ms)
+                frame_times.extend(framestats_ms)
+        
+            frame_time_hist.set_row(i, hist_row)
+        
+            # 计算当前迭代的帧率
+            current_total_frames = int(total_frames_match.group(1)) if total_frames_match else 0
+            current_janky_frames = int(janky_frames_match.group(1)) if janky_frames_match else 0
+            current_janky_percent = float(janky_frames_match.group(2)) if janky_frames_match else 0.0
+        
+            # 如果无法从dumpsys获取帧数，尝试通过详细帧时间数据计算
+            if current_total_frames == 0 and detailed_frame_times:
+                current_total_frames = len(detailed_frame_times)
+        
+            # 计算这个间隔的帧数和帧率
+            frames_in_interval = current_total_frames - prev_total_frames
+        
+            # 如果帧数计算为负数或零，可能是因为重置了计数器，尝试使用备选方法获取
+            if frames_in_interval <= 0:
+                # 尝试使用SurfaceFlinger获取帧率（该设备上已失败过则直接跳过）
+                if sf_fallback_works is not False:
+                    sf_dump = shell.run("dumpsys SurfaceFlinger")
+                    window_line = next((line for line in sf_dump.splitlines() if package_name in line), "")
+                    window_name = window_line.strip().split()[0] if window_line.strip() else ""
                 
-                # 获取延迟数据
-                sf_output = run_adb_command(f"shell dumpsys SurfaceFlinger --latency {window_name}", device_id)
+                    if window_name:
+                        # 清除之前的延迟数据
+                        shell.run(f"dumpsys SurfaceFlinger --latency-clear {window_name}")
+                        time.sleep(interval * 0.8)  # 等待收集数据，稍微短一点以确保在下一次迭代前完成
+                    
+                        # 获取延迟数据
+                        sf_output = shell.run(f"dumpsys SurfaceFlinger --latency {window_name}")
+                    
+                        # 计算帧数 - 每三行数据代表一帧
+                        valid_lines = [line for line in sf_output.split('\n') if _RE_SF_LATENCY_ROW.match(line.strip())]
+                        frames_in_interval = len(valid_lines) // 3
                 
-                # 计算帧数 - 每三行数据代表一帧
-                valid_lines = [line for line in sf_output.split('\n') if re.match(r'\s*\d+', line.strip())]
-                frames_in_interval = len(valid_lines) // 3
+                    sf_fallback_works = frames_in_interval > 0
             
-            # 如果仍然无法获取，标记为无法获取
-            if frames_in_interval <= 0:
-                frames_in_interval = 0
-                print(f"设备 {device_id} - 警告：无法获取帧率数据")
-        
-        fps_in_interval = frames_in_interval / interval if interval > 0 else 0
-        fps_values.append(fps_in_interval)
-        
-        # 更新总计数
-        prev_total_frames = current_total_frames
-        accumulated_frames += frames_in_interval
-        
-        # 处理卡顿帧数 - 如果无法直接获取
-        if current_janky_frames == 0:
-            if frames_in_interval <= 0:
-                # 如果帧数无法获取，卡顿数据也标记为无法获取
-                current_janky_percent = None
-                print(f"设备 {device_id} - 警告：无法获取卡顿帧数据")
+                # 如果仍然无法获取，标记为无法获取
+                if frames_in_interval <= 0:
+                    frames_in_interval = 0
+                    logger.warning("设备 %s - 警告：无法获取帧率数据", device_id)
+        
+            fps_in_interval = frames_in_interval / interval if interval > 0 else 0
+            fps_values[i] = fps_in_interval
+            fps_stats.add(fps_in_interval)
+        
+            # 更新总计数
+            prev_total_frames = current_total_frames
+            accumulated_frames += frames_in_interval
+        
+            # 处理卡顿帧数 - 如果无法直接获取
+            if current_janky_frames == 0:
+                if frames_in_interval <= 0:
+                    # 如果帧数无法获取，卡顿数据也标记为无法获取
+                    current_janky_percent = None
+                    logger.warning("设备 %s - 警告：无法获取卡顿帧数据", device_id)
+                else:
+                    # 如果有帧数但无卡顿数据，标记为无法获取卡顿数据
+                    current_janky_percent = None
+                    logger.warning("设备 %s - 警告：无法获取卡顿帧数据，但帧数正常", device_id)
+                    # 不累加估计的卡顿帧数
             else:
-                # 如果有帧数但无卡顿数据，标记为无法获取卡顿数据
-                current_janky_percent = None
-                print(f"设备 {device_id} - 警告：无法获取卡顿帧数据，但帧数正常")
-                # 不累加估计的卡顿帧数
-        else:
-            accumulated_janky += (current_janky_frames - jank_count)
-            jank_count = current_janky_frames
-        
-        # 记录这次迭代的结果
-        result = {
-            "iteration": iterations,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "fps": fps_in_interval,
-            "total_frames": accumulated_frames,  # 使用累积值
-            "janky_frames": accumulated_janky,  # 使用累积值
-            "janky_percent": current_janky_percent,
-            "frame_time_distribution": frame_time_data,
-            "detailed_frame_times": detailed_frame_times if detailed_frame_times else None
-        }
-        
-        results.append(result)
-        print(f"设备 {device_id} - 迭代 {iterations}: FPS: {fps_in_interval:.1f}, 卡顿: {current_janky_percent:.1f}%")
+                accumulated_janky += (current_janky_frames - jank_count)
+                jank_count = current_janky_frames
+        
+            # 记录这次迭代的结果
+            result = {
+                "iteration": iterations,
+                "timestamp": time.time(),  # 先记录时间戳，导出时再统一格式化
+                "fps": fps_in_interval,
+                "total_frames": accumulated_frames,  # 使用累积值
+                "janky_frames": accumulated_janky,  # 使用累积值
+                "janky_percent": current_janky_percent,
+                "frame_time_distribution": None,  # 导出时由frame_time_hist填充
+                "detailed_frame_times": detailed_frame_times if detailed_frame_times else None
+            }
         
-        # 重置图形信息，准备下一次收集
-        run_adb_command(f"shell dumpsys gfxinfo {package_name} reset", device_id)
+            results[i] = result
+            janky_text = f"{current_janky_percent:.1f}%" if current_janky_percent is not None else "N/A"
+            logger.info("设备 %s - 迭代 %d: FPS: %.1f, 卡顿: %s", device_id, iterations, fps_in_interval, janky_text)
+    
+    # 数据流提前结束时去掉未填充的位置
+    del results[iterations:]
+    del fps_values[iterations:]
     
     # 测试结束后，关闭性能监控
-    run_adb_command(f"shell setprop debug.hwui.profile false", device_id)
-    run_adb_command(f"shell setprop debug.hwui.renderer.profile false", device_id)
-    run_adb_command(f"shell setprop debug.egl.trace 0", device_id)
-    run_adb_command(f"shell service call SurfaceFlinger 1008 i32 0", device_id)  # 关闭帧率统计
+    shell.run(PROFILING_DISABLE_COMMANDS)
     
-    return results, fps_values, frame_times, accumulated_janky, accumulated_frames
+    return (results, fps_values, frame_times, fps_stats, frame_time_stats, frame_time_hist,
+            accumulated_janky, accumulated_frames)
+
+def dump_result_json(data):
+    """将结果序列化为缩进2格的UTF-8 JSON字节串，优先使用orjson，未安装时回退到标准库json"""
+    if orjson is None:
+        return json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+    return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
 
-def process_device(device_id, apk_path, package_name, activity_name, duration, results_dir=None):
-    """处理单个设备的完整流程"""
+def process_device(device_id, apk_path, package_name, activity_name, duration, results_dir):
+    """处理单个设备的完整流程，results_dir由main确定并创建"""
     try:
         # 获取设备信息
         device_info = get_device_info(device_id)
@@ -393,57 +666,54 @@ def process_device(device_id, apk_path, package_name, activity_name, duration, r
             print(f"设备 {device_id} - 错误：APK安装失败")
             return
         
-        # 启用性能监控所需的系统属性
-        print(f"设备 {device_id} - 启用性能监控...")
-        run_adb_command(f"shell setprop debug.hwui.profile true", device_id)
-        run_adb_command(f"shell setprop debug.hwui.renderer.profile true", device_id)
-        run_adb_command(f"shell setprop debug.egl.trace 1", device_id)
-        
-        # 构建完整的组件名称
-        if activity_name.startswith('.'):
-            component = f"{package_name}/{package_name}{activity_name}"
-        elif '.' in activity_name and not activity_name.startswith(package_name):
-            component = f"{package_name}/{activity_name}"
-        else:
-            component = f"{package_name}/{activity_name}"
-        
-        # 启动应用
-        print(f"设备 {device_id} - 启动应用: {component}")
-        run_adb_command(f"shell am force-stop {package_name}", device_id)
-        time.sleep(1)
-        run_adb_command(f"shell am start -n {component}", device_id)
-        
-        # 等待应用完全启动
-        print(f"设备 {device_id} - 等待应用启动...")
-        time.sleep(5)
-        
-        # 收集帧率数据
-        fps_results, fps_values, frame_times, jank_count, total_frames = collect_fps_data(
-            device_id, package_name, duration, interval=1
-        )
+        # 每个设备复用同一个adb shell会话，避免每条命令都启动新的adb进程
+        with AdbShell(device_id) as shell:
+            # 启用性能监控所需的系统属性
+            print(f"设备 {device_id} - 启用性能监控...")
+            shell.run(PROFILING_ENABLE_COMMANDS)
+            
+            # 构建完整的组件名称
+            if activity_name.startswith('.'):
+                component = f"{package_name}/{package_name}{activity_name}"
+            elif '.' in activity_name and not activity_name.startswith(package_name):
+                component = f"{package_name}/{activity_name}"
+            else:
+                component = f"{package_name}/{activity_name}"
+            
+            # 启动应用
+            print(f"设备 {device_id} - 启动应用: {component}")
+            shell.run(f"am force-stop {package_name}")
+            time.sleep(1)
+            shell.run(f"am start -n {component}")
+            
+            # 等待应用完全启动
+            print(f"设备 {device_id} - 等待应用启动...")
+            time.sleep(5)
+            
+            # 只探测一次framestats能力，之后每次采样固定使用同一条命令
+            use_framestats = probe_framestats(shell, package_name)
+            
+            # 收集帧率数据
+            (fps_results, fps_values, frame_times, fps_stats, frame_time_stats, frame_time_hist,
+             jank_count, total_frames) = collect_fps_data(shell, package_name, duration, interval=1,
+                                                          use_framestats=use_framestats)
         
-        # 计算统计数据
+        # 计算统计数据（最值、均值、标准差已在采集时在线累计，只有中位数需要排序一次）
         stats = {}
-        if fps_values:
-            stats["min_fps"] = min(fps_values)
-            stats["max_fps"] = max(fps_values)
-            stats["avg_fps"] = statistics.mean(fps_values)
+        if fps_stats.n:
+            stats["min_fps"] = fps_stats.min
+            stats["max_fps"] = fps_stats.max
+            stats["avg_fps"] = fps_stats.mean
             stats["median_fps"] = statistics.median(fps_values)
-            if len(fps_values) > 1:
-                stats["stdev_fps"] = statistics.stdev(fps_values)
-            else:
-                stats["stdev_fps"] = 0
+            stats["stdev_fps"] = fps_stats.stdev
         
         # 计算帧时间统计
-        if frame_times:
-            stats["min_frame_time"] = min(frame_times)
-            stats["max_frame_time"] = max(frame_times)
-            stats["avg_frame_time"] = statistics.mean(frame_times)
+        if frame_time_stats.n:
+            stats["min_frame_time"] = frame_time_stats.min
+            stats["max_frame_time"] = frame_time_stats.max
+            stats["avg_frame_time"] = frame_time_stats.mean
             stats["median_frame_time"] = statistics.median(frame_times)
-            if len(frame_times) > 1:
-                stats["stdev_frame_time"] = statistics.stdev(frame_times)
-            else:
-                stats["stdev_frame_time"] = 0
+            stats["stdev_frame_time"] = frame_time_stats.stdev
         
         # 计算帧率稳定性指标
         if fps_values and len(fps_values) > 1:
@@ -453,6 +723,11 @@ def process_device(device_id, apk_path, package_name, activity_name, duration, r
             # 帧率稳定性百分比
             stats["fps_stability_percent"] = stats["fps_stability"] * 100
         
+        # 时间戳和帧时间分布只在导出前格式化/还原为字典
+        for i, result in enumerate(fps_results):
+            result["timestamp"] = datetime.fromtimestamp(result["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
+            result["frame_time_distribution"] = frame_time_hist.row_dict(i)
+        
         # 准备完整的结果数据
         result_data = {
             "device_info": device_info,
@@ -474,25 +749,9 @@ def process_device(device_id, apk_path, package_name, activity_name, duration, r
         
         # 保存结果到JSON文件
         device_name = device_info['model']['full_name']
-        
-        # 如果未指定结果目录，则根据系统类型确定默认路径
-        if not results_dir:
-            system_type = get_system_type()
-            if system_type == 'mac':
-                # 在Mac上使用当前目录或指定目录
-                results_dir = os.path.join(os.getcwd(), 'results')
-            elif system_type == 'windows':
-                # 在Windows上使用文档目录
-                results_dir = os.path.join(os.path.expanduser('~'), 'Documents', 'TestAutoResults')
-            else:  # Linux或其他系统
-                results_dir = os.path.join(os.path.expanduser('~'), 'TestAutoResults')
-        
-        # 确保结果目录存在
-        os.makedirs(results_dir, exist_ok=True)
-        
         result_file = os.path.join(results_dir, f"fps_results_{device_name}_{device_id}.json")
-        with open(result_file, 'w', encoding='utf-8') as f:
-            json.dump(result_data, f, ensure_ascii=False, indent=2)
+        with open(result_file, 'wb') as f:
+            f.write(dump_result_json(result_data))
         
         print(f"设备 {device_id} - 结果已保存到: {result_file}")
         print(f"设备 {device_id} - 测试摘要:")
@@ -547,14 +806,17 @@ def main():
         print(f"错误：在目录 {args.apk_dir} 中未找到APK文件")
         return
     
-    # 获取包名
-    package_name = get_package_name(apk_path)
+    # 解析包名（aapt）和检测已连接的设备（adb devices）互不依赖，并行执行
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        package_future = executor.submit(get_package_name, apk_path)
+        devices_future = executor.submit(get_connected_devices)
+        package_name = package_future.result()
+        devices = devices_future.result()
+    
     if not package_name:
         print("错误：无法从APK文件中获取包名")
         return
     
-    # 获取已连接的设备
-    devices = get_connected_devices()
     if not devices:
         print("错误：未找到已连接的设备")
         return
@@ -562,23 +824,27 @@ def main():
     print(f"\n开始在 {len(devices)} 个设备上测量帧率...")
     
     # 使用线程池并行处理多个设备
-    with ThreadPoolExecutor(max_workers=len(devices)) as executor:
-        futures = []
-        for device_id in devices:
-            future = executor.submit(
-                process_device,
-                device_id,
-                apk_path,
-                package_name,
-                args.activity,
-                args.duration,
-                args.results_dir
-            )
-            futures.append(future)
-        
-        # 等待所有设备处理完成
-        for future in futures:
-            future.result()
+    log_listener = start_iteration_logging()
+    try:
+        with ThreadPoolExecutor(max_workers=len(devices)) as executor:
+            futures = []
+            for device_id in devices:
+                future = executor.submit(
+                    process_device,
+                    device_id,
+                    apk_path,
+                    package_name,
+                    args.activity,
+                    args.duration,
+                    args.results_dir
+                )
+                futures.append(future)
+            
+            # 等待所有设备处理完成
+            for future in futures:
+                future.result()
+    finally:
+        log_listener.stop()
     
     print("\n所有设备的帧率测量已完成！")
 
@@ -1,9 +1,15 @@
 import subprocess
 import time
-import argparse
 import os
 import sys
-import shutil
+import string
+import hashlib
+import functools
+import threading
+import zlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from adb_shell import AdbShell
 
 # --- Configuration ---
 # Default categories for Systrace (can be overridden)
@@ -12,164 +18,260 @@ DEFAULT_SYSTRACE_CATEGORIES = [
     "binder_driver", "binder_lock", "hal", "res", "dalvik", "app"
 ]
 
+# Default ftrace events for startup analysis (can be overridden with --ftrace-events).
+# High-rate events such as sched/sched_switch, sched/sched_waking and binder transactions
+# are left out by default because they dominate ring-buffer bandwidth on busy devices.
+DEFAULT_FTRACE_EVENTS = [
+    # Power events
+    "power/cpu_frequency",
+    "power/cpu_idle",
+    "sched/sched_wakeup_new",
+    # App lifecycle events (might require specific Android versions/OEMs)
+    "am/am_activity_launch",
+    "am/am_proc_start",
+    "am/am_activity_resume",
+]
+
+# Default atrace categories for Perfetto (can be overridden with --perfetto-atrace-categories).
+# Perfetto expands each category into its ftrace events, so the high-rate "sched" (sched_switch/sched_waking/
+# sched_wakeup), "freq" (cpu_frequency and clock events) and "binder_driver" (binder transactions) categories
+# are left out to keep the lean DEFAULT_FTRACE_EVENTS effective; pass them explicitly when needed.
+DEFAULT_PERFETTO_ATRACE_CATEGORIES = [
+    "gfx",         # Graphics
+    "view",        # View System / UI Toolkit
+    "input",       # Input Pipeline
+    "wm",          # Window Manager
+    "am",          # Activity Manager
+    "res",         # Resource Loading
+    "dalvik",      # ART/Dalvik VM Info
+    "binder_lock", # Binder Lock Contention
+    "hal",         # Hardware Abstraction Layers
+]
+
+# Low-rate task events that name processes started during the trace (such as the freshly launched app),
+# used in place of a full /proc scan at trace start
+PROCESS_NAMING_FTRACE_EVENTS = [
+    "task/task_newtask",
+    "task/task_rename",
+]
+
+# Disk I/O sync event per /data filesystem type; only the one matching the device is added
+DISK_SYNC_FTRACE_EVENTS = {
+    "ext4": "ext4/ext4_sync_file_enter",
+    "f2fs": "f2fs/f2fs_sync_file_enter",
+}
+
 # Base Perfetto config (duration and app tracing will be added)
 # Includes common categories useful for general performance and startup analysis
 # Refer to https://perfetto.dev/docs/concepts/config for more options
-DEFAULT_PERFETTO_CONFIG_TEMPLATE = """
-buffers: {{
-    size_kb: 63488 # 64MB buffer size
+DEFAULT_PERFETTO_CONFIG_TEMPLATE = string.Template("""
+buffers: {
+    size_kb: 63488 # 64MB buffer for ftrace/atrace events
+    fill_policy: RING_BUFFER
+}
+buffers: {
+    size_kb: 4096  # Separate metadata buffer so process info is not evicted by ftrace
     fill_policy: RING_BUFFER
-}}
-buffers: {{
-    size_kb: 2048  # Smaller buffer for less frequent metadata
+}
+buffers: {
+    size_kb: 128   # Small persistent buffer for the packages list
     fill_policy: RING_BUFFER
-}}
-data_sources: {{
-    config {{
+}
+# Periodically drain buffers into the output so long traces do not overwrite early events
+write_into_file: true
+file_write_period_ms: 1000
+max_file_size_bytes: 1073741824 # Stop at 1GB
+incremental_state_config {
+    clear_period_ms: 5000
+}
+data_sources: {
+    config {
+        name: "android.packages_list"
+        target_buffer: 2
+    }
+}
+data_sources: {
+    config {
         name: "linux.process_stats"
         target_buffer: 1
-        process_stats_config {{
-            scan_all_processes_on_start: true
-        }}
-    }}
-}}
+        process_stats_config {
+            $process_stats_config
+        }
+    }
+}
 # --- Ftrace config: Add categories relevant to startup and rendering ---
-data_sources: {{
-    config {{
+data_sources: {
+    config {
         name: "linux.ftrace"
-        ftrace_config {{
-            # Core scheduling and power events
-            ftrace_events: "sched/sched_switch"
-            ftrace_events: "power/cpu_frequency"
-            ftrace_events: "power/cpu_idle"
-            ftrace_events: "sched/sched_waking"
-            ftrace_events: "sched/sched_wakeup_new"
-            # App lifecycle events (might require specific Android versions/OEMs)
-            ftrace_events: "am/am_activity_launch"
-            ftrace_events: "am/am_proc_start"
-            ftrace_events: "am/am_activity_resume"
-            # Binder (IPC) tracing
-            ftrace_events: "binder/binder_transaction"
-            ftrace_events: "binder/binder_transaction_received"
-            # Disk I/O
-            ftrace_events: "ext4/ext4_sync_file_enter" # Example for ext4
-            ftrace_events: "f2fs/f2fs_sync_file_enter" # Example for f2fs
-            # Atrace categories mirror Systrace for high-level events
-            atrace_categories: "gfx"           # Graphics
-            atrace_categories: "view"          # View System / UI Toolkit
-            atrace_categories: "input"         # Input Pipeline
-            atrace_categories: "wm"            # Window Manager
-            atrace_categories: "am"            # Activity Manager
-            atrace_categories: "res"           # Resource Loading
-            atrace_categories: "dalvik"        # ART/Dalvik VM Info
-            atrace_categories: "sched"         # CPU Scheduling
-            atrace_categories: "freq"          # CPU Frequency Scaling
-            atrace_categories: "binder_driver" # Binder Kernel Driver
-            atrace_categories: "binder_lock"   # Binder Lock Contention
-            atrace_categories: "hal"           # Hardware Abstraction Layers
+        ftrace_config {
+            # Ftrace events (see DEFAULT_FTRACE_EVENTS / --ftrace-events)
+            $ftrace_events_block
+            # Atrace categories for high-level events (see DEFAULT_PERFETTO_ATRACE_CATEGORIES / --perfetto-atrace-categories)
+            $atrace_categories_block
             # Add specific app to trace if provided
-            {atrace_apps_config}
-        }}
-    }}
-}}
+            $atrace_apps_config
+        }
+    }
+}
 # --- Trace duration placeholder ---
-{duration_config}
+$duration_config
 # Optional: Add memory or other data sources if needed
 # data_sources: { ... heapprofd config ... }
 # data_sources: { ... android.gpu.memory ... }
-"""
+""")
+
+# Status and error messages go through this logger; main() sends it to stderr (WARNING and up unless -v)
+logger = logging.getLogger('trace')
 
 # --- Helper Functions ---
 
-def run_command(cmd_list, capture_output=True, text=True, check=False, **kwargs):
-    """Runs a command using subprocess and returns the result."""
-    print(f"--- Executing: {' '.join(cmd_list)}")
+def _read_spooled(f, text):
+    """Reads back output spooled to a temporary file (used for the long-running systrace.py process)."""
+    f.seek(0)
+    data = f.read()
+    return data.decode('utf-8', errors='replace') if text else data
+
+def run_command(cmd_list, capture_output=True, text=False, check=False, **kwargs):
+    """Runs a command using subprocess and returns the result.
+
+    Output is kept as bytes unless text=True; only pass text=True when stdout is parsed.
+    """
+    logger.info("Executing: %s", ' '.join(cmd_list))
     try:
         result = subprocess.run(cmd_list, capture_output=capture_output, text=text, check=check, **kwargs)
         if result.returncode != 0:
-            print(f"--- WARNING: Command returned non-zero exit code {result.returncode}", file=sys.stderr)
+            logger.warning("Command returned non-zero exit code %s", result.returncode)
             if result.stderr:
-                print(f"--- Stderr:\n{result.stderr}", file=sys.stderr)
+                stderr = result.stderr if text else result.stderr.decode('utf-8', errors='replace')
+                logger.warning("Stderr:\n%s", stderr)
         return result
     except FileNotFoundError:
-        print(f"--- ERROR: Command not found: {cmd_list[0]}. Is it in your PATH?", file=sys.stderr)
+        logger.error("Command not found: %s. Is it in your PATH?", cmd_list[0])
         return None
     except Exception as e:
-        print(f"--- ERROR executing command: {e}", file=sys.stderr)
+        logger.error("Error executing command: %s", e)
         return None
 
 def run_adb_command(adb_args, **kwargs):
-    """Prepends 'adb' to the command list and runs it."""
+    """Prepends 'adb' to the command list and runs it (for one-shot verbs like devices/pull)."""
     return run_command(['adb'] + adb_args, **kwargs)
 
+def run_shell_command(shell, command):
+    """Runs a command in the persistent adb shell session. Returns (stdout, exit_code)."""
+    logger.info("Executing (adb shell): %s", command)
+    output = shell.run(command)
+    if shell.returncode != 0:
+        logger.warning("Command returned non-zero exit code %s", shell.returncode)
+        if output:
+            logger.warning("Output:\n%s", output)
+    return output, shell.returncode
+
+# Android API level of the connected device, filled in by check_device_connected()
+DEVICE_SDK_INT = None
+
+DEVICE_WAIT_TIMEOUT_S = 30
+
 def check_device_connected():
-    """Checks if an ADB device is connected and authorized."""
-    result = run_adb_command(['devices'])
+    """Waits for an authorized ADB device to finish booting and records its API level."""
+    global DEVICE_SDK_INT
+    # One adb call: wait for the device, wait for boot to complete, then report model and SDK level
+    script = ('while [ "$(getprop sys.boot_completed)" != "1" ]; do sleep 0.2; done; '
+              'getprop ro.product.model; getprop ro.build.version.sdk')
+    result = run_adb_command(['wait-for-device', 'shell', script], text=True, timeout=DEVICE_WAIT_TIMEOUT_S)
     if result is None or result.returncode != 0:
+        logger.error("No booted, authorized ADB device found. Ensure device is connected, USB Debugging is enabled "
+                     "and the authorization prompt was accepted.")
         return False
-    # Output format:
-    # List of devices attached
-    # emulator-5554	device
-    # <serial>      offline|unauthorized|device
     lines = result.stdout.strip().splitlines()
-    if len(lines) <= 1:
-        print("--- ERROR: No ADB devices found. Ensure device is connected and USB Debugging is enabled.", file=sys.stderr)
+    if len(lines) < 2:
+        logger.error("Unexpected device info output: %r", result.stdout)
         return False
-    for line in lines[1:]: # Skip header line
-        if '\tdevice' in line:
-            print(f"--- Found device: {line.split()[0]}")
+    model, sdk = lines[-2].strip(), lines[-1].strip()
+    DEVICE_SDK_INT = int(sdk) if sdk.isdigit() else None
+    logger.info("Found device: %s (SDK %s)", model, sdk)
+    return True
+
+def wait_process_gone(package_name, timeout_s=2.0, poll_s=0.05):
+    """Returns a device-side shell snippet that polls pidof until the app process is gone (or timeout_s passes)."""
+    max_polls = int(timeout_s / poll_s)
+    return (f"i=0; while pidof {package_name} >/dev/null && [ $i -lt {max_polls} ]; "
+            f"do sleep {poll_s}; i=$((i+1)); done")
+
+def wait_for_output(spool_file, marker, proc, timeout_s=5.0, poll_s=0.05):
+    """Polls output spooled to spool_file until marker appears, proc exits or timeout_s passes.
+
+    Returns True if the marker was seen.
+    """
+    if not hasattr(os, 'pread'):
+        # No positional reads (e.g. Windows); reading would move the offset shared with the child
+        time.sleep(1)
+        return True
+    deadline = time.monotonic() + timeout_s
+    while time.monotonic() < deadline:
+        if marker in os.pread(spool_file.fileno(), 64 * 1024, 0):
             return True
-    print("--- ERROR: No authorized ADB device found. Check device screen for authorization prompt.", file=sys.stderr)
+        if proc.poll() is not None:
+            return False
+        time.sleep(poll_s)
     return False
 
-def find_systrace_script(systrace_path_hint=None):
-    """Tries to find systrace.py."""
-    # 1. Use provided hint
-    if systrace_path_hint and os.path.isfile(systrace_path_hint) and systrace_path_hint.endswith('systrace.py'):
-        print(f"--- Using provided systrace path: {systrace_path_hint}")
-        return systrace_path_hint
-
-    # 2. Check common locations (Android SDK platform-tools)
-    sdk_root = os.environ.get('ANDROID_HOME') or os.environ.get('ANDROID_SDK_ROOT')
-    if sdk_root:
-        potential_path = os.path.join(sdk_root, 'platform-tools', 'systrace', 'systrace.py')
-        if os.path.isfile(potential_path):
-            print(f"--- Found systrace.py in SDK: {potential_path}")
-            return potential_path
-
-    # 3. Check system PATH (less common for systrace.py)
-    systrace_in_path = shutil.which('systrace.py')
-    if systrace_in_path:
-         print(f"--- Found systrace.py in PATH: {systrace_in_path}")
-         return systrace_in_path
-
-    print("--- ERROR: Could not automatically find systrace.py.", file=sys.stderr)
-    print("--- Please install Android SDK Platform-Tools and ensure ANDROID_HOME is set,", file=sys.stderr)
-    print("--- or provide the path using the --systrace-path argument.", file=sys.stderr)
-    return None
-
-def force_stop_app(package_name):
-    """Forces the target application to stop for a cold start."""
-    print(f"--- Force stopping app: {package_name}")
-    run_adb_command(['shell', 'am', 'force-stop', package_name])
-    time.sleep(1) # Give system a moment to settle
-
-def launch_app(package_name, activity_name):
-    """Launches the specified activity."""
-    print(f"--- Launching: {package_name}/{activity_name}")
-    # -S: Force stop before launch (redundant if force_stop_app was called, but safe)
-    # -W: Wait for launch to complete (optional here, as trace runs for fixed duration)
+def prepare_and_launch(shell, package_name, activity_name, wait_for_launch=False):
+    """Force-stops the app, lets the system settle and launches the activity in one shell round trip."""
+    logger.info("Cold-starting: %s/%s", package_name, activity_name)
+    # -S: Force stop before launch (redundant after am force-stop, but safe)
+    # -W (only with wait_for_launch): block until launch completes and report TotalTime/WaitTime.
+    #     Not needed by default, the trace captures the launch timing itself.
     # --activity-clear-task: Ensure a new task is created
     component = f"{package_name}/{activity_name}"
-    run_adb_command(['shell', 'am', 'start', '-S', '-W', '--activity-clear-task', component])
-    print("--- App launch command sent.")
+    wait_flag = "-W " if wait_for_launch else ""
+    script = "; ".join([
+        f"am force-stop {package_name}",
+        wait_process_gone(package_name),  # Wait until the process is really gone (device-side, no extra round trip)
+        f"am start -S {wait_flag}--activity-clear-task {component}",
+    ])
+    output, _ = run_shell_command(shell, script)
+    if wait_for_launch and output:
+        print(output)
+    logger.info("App launch command sent.")
+
+def launch_app_async(shell, package_name, activity_name, wait_for_launch=False, trace_ready=True,
+                     fallback_delay_ms=500):
+    """Launches the app on a background thread, so the caller can wait on the trace meanwhile.
+
+    The launch is gated on the tracer's readiness signal: when trace_ready is True the tracer has confirmed it
+    is recording and the launch starts at once. Only when it could not confirm this is fallback_delay_ms
+    waited first. Returns the started thread.
+    """
+    def _launch():
+        if not trace_ready:
+            time.sleep(fallback_delay_ms / 1000)
+        prepare_and_launch(shell, package_name, activity_name, wait_for_launch)
+
+    # Daemon thread: an early sys.exit on trace failure must not hang on the launch
+    launch_thread = threading.Thread(target=_launch, name="app-launch", daemon=True)
+    launch_thread.start()
+    return launch_thread
 
 # --- Tracing Functions ---
 
-def run_perfetto_trace(package_name, duration_s, output_file):
-    """Runs Perfetto tracing on the device."""
-    print("--- Starting Perfetto trace...")
-    device_trace_path = "/data/misc/perfetto-traces/perfetto_trace.pftrace" # Standard location
+# Rendered configs are cached on the device under their content hash, so repeated runs skip the upload.
+# Only the most recently used PERFETTO_CONFIG_CACHE_SIZE configs are kept.
+PERFETTO_CONFIG_CACHE_DIR = "/data/local/tmp/pftcfg"
+PERFETTO_CONFIG_CACHE_SIZE = 20
+# Traces are recorded into a device file here (the one location traced may write to on user builds)
+# and pulled once the session ends
+PERFETTO_DEVICE_TRACE_DIR = "/data/misc/perfetto-traces"
+# Pulled traces are written under this suffix and renamed only once complete
+PARTIAL_TRACE_SUFFIX = ".part"
+# How long to wait for Perfetto to start recording; the first write comes after file_write_period_ms
+PERFETTO_READY_TIMEOUT_S = 5.0
+# Extra time allowed after the trace duration for Perfetto to flush and exit
+PERFETTO_FINISH_TIMEOUT_S = 30
+
+@functools.lru_cache(maxsize=16)
+def render_perfetto_config(package_name, duration_s, ftrace_events, broad_process_scan=False,
+                           atrace_categories=tuple(DEFAULT_PERFETTO_ATRACE_CATEGORIES)):
+    """Renders the Perfetto text config; ftrace_events and atrace_categories must be tuples so results can be cached."""
     duration_ms = duration_s * 1000
 
     # Prepare Perfetto config
@@ -179,217 +281,394 @@ def run_perfetto_trace(package_name, duration_s, output_file):
          # Note: Ensure your app uses android.os.Trace for app-level sections to appear
          atrace_apps_config = f'atrace_apps: "{package_name}"'
 
-    perfetto_config = DEFAULT_PERFETTO_CONFIG_TEMPLATE.format(
+    # Scanning every process in /proc at start floods the metadata buffer on busy devices; by default only
+    # processes created during the trace are named, via the task events
+    if broad_process_scan:
+        process_stats_config = "scan_all_processes_on_start: true\n            record_thread_names: true"
+    else:
+        process_stats_config = "record_thread_names: true"
+        ftrace_events += tuple(e for e in PROCESS_NAMING_FTRACE_EVENTS if e not in ftrace_events)
+
+    ftrace_events_block = "\n            ".join(f'ftrace_events: "{e}"' for e in ftrace_events)
+    # 'app' is a systrace.py pseudo-category; apps are traced via atrace_apps instead
+    atrace_categories_block = "\n            ".join(f'atrace_categories: "{c}"' for c in atrace_categories if c != 'app')
+
+    return DEFAULT_PERFETTO_CONFIG_TEMPLATE.substitute(
         duration_config=duration_config,
-        atrace_apps_config=atrace_apps_config
+        atrace_apps_config=atrace_apps_config,
+        ftrace_events_block=ftrace_events_block,
+        atrace_categories_block=atrace_categories_block,
+        process_stats_config=process_stats_config
     ).strip()
 
-    # Command to start tracing on device. This command blocks until tracing is done.
-    cmd = [
-        'shell', 'perfetto',
-        '-c', '-', # Read config from stdin
-        '--txt',   # Input config is text proto
-        '-o', device_trace_path
-    ]
+def push_perfetto_config(shell, perfetto_config):
+    """Stages the config on the device, skipping the upload if an identical one is already there.
+
+    Returns the device path of the config, or None on failure.
+    """
+    digest = hashlib.sha256(perfetto_config.encode('utf-8')).hexdigest()[:16]
+    device_path = f"{PERFETTO_CONFIG_CACHE_DIR}/{digest}.pbtx"
+    # On a hit, touch the file so it counts as recently used for eviction
+    probe = shell.run(f"test -f {device_path} && touch {device_path} && echo H || echo M")
+    if probe.strip() == "H":
+        logger.info("Reusing Perfetto config already on device: %s", device_path)
+        return device_path
+
+    logger.info("Writing Perfetto config to device: %s", device_path)
+    # Stream the config over stdin of a one-off adb shell, so its size and contents never reach a command line.
+    # Write to a temp name first so an interrupted upload is never mistaken for a cached config.
+    result = run_adb_command(['shell', f"mkdir -p {PERFETTO_CONFIG_CACHE_DIR} && "
+                                       f"cat > {device_path}.tmp && mv {device_path}.tmp {device_path}"],
+                             input=(perfetto_config + "\n").encode('utf-8'))
+    if result is None or result.returncode != 0:
+        logger.error("Failed to write Perfetto config to device.")
+        return None
+
+    # Evict least recently used configs (subshell so the session's working directory is unchanged)
+    shell.run(f"(cd {PERFETTO_CONFIG_CACHE_DIR} && ls -t | tail -n +{PERFETTO_CONFIG_CACHE_SIZE + 1} | "
+              f"while read f; do rm -f \"$f\"; done)")
+    return device_path
+
+def get_app_pid(shell, package_name):
+    """Returns the pid of the running app process, or None if it is not running."""
+    output = shell.run(f"pidof {package_name}").split()
+    return output[0] if output and output[0].isdigit() else None
+
+def detect_data_filesystem(shell):
+    """Returns the filesystem type of /data on the device (e.g. 'ext4', 'f2fs'), or None if unknown."""
+    mounts = shell.run("cat /proc/mounts")
+    for line in mounts.splitlines():
+        fields = line.split()
+        if len(fields) >= 3 and fields[1] == '/data':
+            logger.info("Detected /data filesystem: %s", fields[2])
+            return fields[2]
+    return None
+
+def resolve_ftrace_events(shell, requested_events=None):
+    """Returns the ftrace events to record: the user's list as-is, or the defaults plus the matching disk sync event."""
+    if requested_events:
+        return list(requested_events)
+    events = list(DEFAULT_FTRACE_EVENTS)
+    sync_event = DISK_SYNC_FTRACE_EVENTS.get(detect_data_filesystem(shell))
+    if sync_event:
+        events.append(sync_event)
+    return events
+
+def start_perfetto_trace(shell, package_name, duration_s, ftrace_events=DEFAULT_FTRACE_EVENTS,
+                         broad_process_scan=False, atrace_categories=DEFAULT_PERFETTO_ATRACE_CATEGORIES):
+    """Starts a background Perfetto session that records into a file on the device.
+
+    Blocks until the session is recording (or PERFETTO_READY_TIMEOUT_S passes), so an app launched afterwards
+    is inside the trace. Returns (perfetto pid, device trace path, start time, whether recording was confirmed),
+    or None on failure.
+    """
+    logger.info("Starting Perfetto trace...")
+    if DEVICE_SDK_INT is not None and DEVICE_SDK_INT < 28:
+        logger.error("Perfetto requires Android 9 (SDK 28) or newer, device is SDK %s.", DEVICE_SDK_INT)
+        return None
 
-    # Run the command, feeding the config via stdin
-    perfetto_proc = run_adb_command(cmd, stdin=perfetto_config, check=False) # Don't check=True as it might return non-zero sometimes
+    perfetto_config = render_perfetto_config(package_name, duration_s, tuple(ftrace_events), broad_process_scan,
+                                             tuple(atrace_categories))
+    config_path = push_perfetto_config(shell, perfetto_config)
+    if not config_path:
+        return None
 
-    if perfetto_proc is None or (perfetto_proc.returncode != 0 and "Tracer FAILED" in (perfetto_proc.stderr or "")):
-        print("--- ERROR: Perfetto tracing failed to start or execute properly on device.", file=sys.stderr)
+    # --background prints the pid of the daemonized perfetto and returns; traced writes the trace to device_path.
+    # Android 12+ blocks perfetto from reading configs under /data/local/tmp, so pipe it in there;
+    # older releases can read the file directly.
+    device_path = f"{PERFETTO_DEVICE_TRACE_DIR}/testauto_{int(time.time())}.pftrace"
+    if DEVICE_SDK_INT is not None and DEVICE_SDK_INT < 31:
+        perfetto_cmd = f"perfetto -c {config_path} --txt --background -o {device_path}"
+    else:
+        perfetto_cmd = f"cat {config_path} | perfetto -c - --txt --background -o {device_path}"
+    # stderr is kept (the shell session merges it into the output) so start failures are reported with perfetto's
+    # own message; the pid is the last all-digit line
+    output, exit_code = run_shell_command(shell, perfetto_cmd)
+    pid = next((line.strip() for line in reversed(output.splitlines()) if line.strip().isdigit()), "")
+    if exit_code != 0 or not pid:
+        logger.error("Perfetto tracing failed to start: %s", output)
+        return None
+    start_time = time.monotonic()
+
+    # traced only writes into the file once the session is recording; wait for that on the device
+    polls = int(PERFETTO_READY_TIMEOUT_S / 0.05)
+    state = shell.run(f"i=0; while [ ! -s {device_path} ] && kill -0 {pid} 2>/dev/null && [ $i -lt {polls} ]; "
+                      f"do sleep 0.05; i=$((i+1)); done; "
+                      f"if [ -s {device_path} ]; then echo READY; elif kill -0 {pid} 2>/dev/null; then echo WAIT; "
+                      f"else echo EXIT; fi").strip()
+    if state == "EXIT":
+        logger.error("Perfetto exited before tracing started.")
+        return None
+    if state != "READY":
+        logger.warning("No trace data after %ss; continuing, the start of the trace may be missed.", PERFETTO_READY_TIMEOUT_S)
+    return pid, device_path, start_time, state == "READY"
+
+def _verify_trace(path):
+    """Logs the trace's size and BLAKE2b digest for reproducibility audits, hashing it without loading it whole."""
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'): # Python 3.11+
+            h = hashlib.file_digest(f, 'blake2b')
+        else:
+            h = hashlib.blake2b()
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    logger.info("Trace digest (blake2b): %s (%s bytes)", h.hexdigest(), os.path.getsize(path))
+    return h.hexdigest()
+
+def finish_perfetto_trace(shell, perfetto_session, duration_s, output_file):
+    """Waits for the background Perfetto session to end, then pulls the trace into output_file."""
+    pid, device_path, start_time, _ = perfetto_session
+    logger.info("Waiting for Perfetto trace to finish (duration: %ss)...", duration_s)
+    # Sleep out the trace on the host so the shell session stays free, then wait for the final flush
+    remaining = duration_s - (time.monotonic() - start_time)
+    if remaining > 0:
+        time.sleep(remaining)
+    polls = int(PERFETTO_FINISH_TIMEOUT_S / 0.2)
+    state = shell.run(f"i=0; while kill -0 {pid} 2>/dev/null && [ $i -lt {polls} ]; do sleep 0.2; i=$((i+1)); done; "
+                      f"kill -0 {pid} 2>/dev/null && echo RUNNING || echo DONE").strip()
+    if state != "DONE":
+        logger.error("Perfetto trace did not finish in time. Terminating.")
+        shell.run(f"kill {pid}; rm -f {device_path}")
         return False
 
-    print(f"--- Perfetto trace completed on device. Trace duration: {duration_s}s")
+    partial_file = output_file + PARTIAL_TRACE_SUFFIX
+    try:
+        result = run_adb_command(['pull', device_path, partial_file])
+        shell.run(f"rm -f {device_path}")
+        if result is None or result.returncode != 0 or not os.path.isfile(partial_file) or not os.path.getsize(partial_file):
+            logger.error("Failed to pull the Perfetto trace from %s.", device_path)
+            return False
+        os.replace(partial_file, output_file)
+    finally:
+        # Never leave a partial trace behind; after a successful os.replace there is nothing left to remove
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+    logger.info("Perfetto trace saved successfully to: %s", output_file)
+    _verify_trace(output_file)
+    return True
 
-    # Pull the trace file
-    print(f"--- Pulling trace file from {device_trace_path} to {output_file}")
-    pull_result = run_adb_command(['pull', device_trace_path, output_file])
-    if pull_result is None or pull_result.returncode != 0 or "error" in (pull_result.stderr or "").lower():
-         print(f"--- ERROR: Failed to pull Perfetto trace file from device.", file=sys.stderr)
-         # Attempt to remove the device file anyway if pull failed partially
-         run_adb_command(['shell', 'rm', device_trace_path])
-         return False
 
-    # Clean up trace file on device
-    print(f"--- Cleaning up trace file on device: {device_trace_path}")
-    run_adb_command(['shell', 'rm', device_trace_path])
+ATRACE_BUFFER_KB = 16384
 
-    print(f"--- Perfetto trace saved successfully to: {output_file}")
-    return True
+def start_atrace_trace(shell, package_name, categories):
+    """Starts atrace asynchronously on the device. Returns the start time, or None on failure."""
+    logger.info("Starting atrace trace...")
+    # 'app' is a systrace.py pseudo-category; atrace traces apps via -a instead
+    atrace_categories = " ".join(c for c in categories if c != 'app')
+    app_args = f"-a {package_name} " if package_name else ""
+    output, exit_code = run_shell_command(
+        shell, f"atrace -b {ATRACE_BUFFER_KB} --async_start {app_args}{atrace_categories}")
+    if exit_code != 0:
+        logger.error("atrace failed to start: %s", output)
+        return None
+    return time.monotonic()
 
+def finish_atrace_trace(start_time, duration_s, output_file):
+    """Waits out the trace duration, then stops atrace and saves the decompressed text trace."""
+    remaining = duration_s - (time.monotonic() - start_time)
+    if remaining > 0:
+        logger.info("Tracing for %.1fs more...", remaining)
+        time.sleep(remaining)
 
-def run_systrace_trace(package_name, duration_s, output_file, systrace_script_path, categories):
-    """Runs Systrace using the systrace.py script."""
-    print("--- Starting Systrace trace...")
-
-    if not systrace_script_path:
-        systrace_script_path = find_systrace_script()
-        if not systrace_script_path:
-            return False # Error message already printed
-
-    # Build the command
-    # Note: systrace.py is often Python 2, but recent versions might support Python 3
-    # Try 'python' first, which might resolve to python3 or python2 depending on system.
-    python_executable = sys.executable # Use the same python running this script
-    cmd = [
-        python_executable,
-        systrace_script_path,
-        '--time', str(duration_s),
-        '-o', output_file
-    ]
-    if package_name:
-        cmd.extend(['-a', package_name]) # Trace specific app
-
-    # Add categories (filter out 'app' if package_name is not provided)
-    trace_categories = categories[:] # Copy list
-    if not package_name and 'app' in trace_categories:
-        trace_categories.remove('app')
-    cmd.extend(trace_categories)
-
-    # Systrace runs for the specified duration and then exits
-    systrace_result = run_command(cmd, check=False) # Don't check, handle errors manually
-
-    if systrace_result is None or systrace_result.returncode != 0:
-        print("--- ERROR: Systrace execution failed.", file=sys.stderr)
-        if systrace_result and systrace_result.stderr:
-             # Provide more specific feedback if possible
-             if "No such file or directory" in systrace_result.stderr and python_executable == 'python':
-                  print("--- Hint: Try specifying 'python2' or 'python3' explicitly if 'python' is not correct.", file=sys.stderr)
-             elif "No devices found" in systrace_result.stderr:
-                  print("--- Hint: Ensure device is connected and authorized via ADB.", file=sys.stderr)
+    # -z compresses the dump on the device; exec-out keeps the binary stream intact
+    result = run_adb_command(['exec-out', 'atrace', '--async_stop', '-z'])
+    if result is None or result.returncode != 0:
+        logger.error("Failed to stop atrace and collect the trace.")
         return False
-    elif "Unable to find package" in (systrace_result.stdout or ""):
-         print(f"--- ERROR: Systrace could not find the package '{package_name}'. Is it installed?", file=sys.stderr)
-         # Clean up potentially empty/invalid trace file
-         if os.path.exists(output_file):
-            os.remove(output_file)
-         return False
 
-
-    print(f"--- Systrace trace saved successfully to: {output_file}")
+    # Output is a short text preamble, a 'TRACE:' marker line and the zlib-compressed trace
+    _, marker, payload = result.stdout.partition(b"TRACE:\n")
+    if not marker:
+        logger.error("atrace output did not contain trace data.")
+        return False
+    try:
+        trace_text = zlib.decompress(payload)
+    except zlib.error:
+        trace_text = payload # Device ignored -z; keep the raw text
+
+    with open(output_file, 'wb') as f:
+        f.write(b"TRACE:\n" + trace_text)
+    logger.info("atrace trace saved successfully to: %s", output_file)
+    _verify_trace(output_file)
     return True
 
 # --- Main Execution ---
 
 def main():
-    parser = argparse.ArgumentParser(description="Run Perfetto or Systrace for Android app performance analysis.")
+    import argparse
+    parser = argparse.ArgumentParser(description="Run Perfetto, atrace or Systrace for Android app performance analysis.")
     parser.add_argument("-p", "--package", required=True, help="Package name of the target application (e.g., com.example.app).")
     parser.add_argument("-a", "--activity", required=True, help="Fully qualified name of the main activity to launch (e.g., .MainActivity or com.example.app.MainActivity).")
-    parser.add_argument("-t", "--tool", choices=['perfetto', 'systrace'], default='perfetto', help="Tracing tool to use (default: perfetto).")
+    parser.add_argument("-t", "--tool", choices=['perfetto', 'atrace', 'systrace'], default='perfetto', help="Tracing tool to use (default: perfetto). 'atrace' runs directly on the device without systrace.py.")
     parser.add_argument("-d", "--duration", type=int, default=10, help="Duration of the trace in seconds (default: 10).")
     parser.add_argument("--perfetto-out", default="perfetto_trace.pftrace", help="Output filename for Perfetto trace (default: perfetto_trace.pftrace).")
     parser.add_argument("--systrace-out", default="systrace_trace.html", help="Output filename for Systrace trace (default: systrace_trace.html).")
+    parser.add_argument("--atrace-out", default="atrace_trace.txt", help="Output filename for atrace text trace (default: atrace_trace.txt).")
     parser.add_argument("--systrace-path", help="Explicit path to systrace.py script (optional, attempts auto-detection).")
-    parser.add_argument("--systrace-categories", nargs='+', default=DEFAULT_SYSTRACE_CATEGORIES, help=f"Space-separated list of Systrace categories (default: {' '.join(DEFAULT_SYSTRACE_CATEGORIES)}).")
+    parser.add_argument("--systrace-categories", nargs='+', default=DEFAULT_SYSTRACE_CATEGORIES, help=f"Space-separated list of Systrace/atrace categories (default: {' '.join(DEFAULT_SYSTRACE_CATEGORIES)}).")
+    parser.add_argument("--perfetto-atrace-categories", nargs='+', default=DEFAULT_PERFETTO_ATRACE_CATEGORIES, help=f"Space-separated list of atrace categories recorded by Perfetto (default: {' '.join(DEFAULT_PERFETTO_ATRACE_CATEGORIES)}; add sched, freq or binder_driver for their high-rate events).")
+    parser.add_argument("--ftrace-events", nargs='+', help=f"Space-separated list of Perfetto ftrace events (default: {' '.join(DEFAULT_FTRACE_EVENTS)} plus the ext4/f2fs sync event matching /data).")
+    parser.add_argument("--wait-for-launch", action="store_true", help="Use 'am start -W' to block until launch completes and print its TotalTime/WaitTime.")
+    parser.add_argument("--launch-delay-ms", type=int, default=500, help="Fallback delay before launching the app when the tracer could not confirm it is recording, in ms (default: 500). Not applied when it did.")
     parser.add_argument("--skip-launch", action="store_true", help="Skip force-stopping and launching the app (useful if app is already running).")
+    parser.add_argument("--broad-process-scan", action="store_true", help="Have Perfetto scan all processes at trace start (larger trace; default names only processes started during the trace).")
+
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show progress messages, not just warnings and errors.")
 
     args = parser.parse_args()
 
-    # --- Pre-flight Checks ---
-    if not check_device_connected():
-        sys.exit(1)
+    # One handler for all diagnostics; the trace results themselves are still printed to stdout
+    log_handler = logging.StreamHandler(sys.stderr)
+    log_handler.setFormatter(logging.Formatter('--- %(levelname)s: %(message)s'))
+    logger.addHandler(log_handler)
+    logger.setLevel(logging.INFO if args.verbose else logging.WARNING)
+    logger.propagate = False
 
+    # --- Pre-flight Checks ---
+    # The device check and the systrace.py lookup are independent, so run them concurrently
     systrace_script_path = args.systrace_path
-    if args.tool == 'systrace' and not systrace_script_path:
-        systrace_script_path = find_systrace_script()
-        if not systrace_script_path:
-             sys.exit(1)
-
-    # --- Prepare App (Cold Start) ---
-    if not args.skip_launch:
-        force_stop_app(args.package)
-        # Add a small delay AFTER force-stop and BEFORE starting trace/launch
-        time.sleep(1)
-
-
-    # --- Start Tracing ---
-    trace_started = False
-    if args.tool == 'perfetto':
-        print("\n=== Starting Perfetto Test ===")
-        trace_started = run_perfetto_trace(args.package, args.duration, args.perfetto_out)
-
-    elif args.tool == 'systrace':
-        print("\n=== Starting Systrace Test ===")
-        # Systrace needs app launch DURING tracing window
-        # Start systrace command (it will run for args.duration)
-        # We will launch the app immediately after starting the trace process
-        python_executable = sys.executable
-        cmd = [
-            python_executable,
-            systrace_script_path,
-            '--time', str(args.duration),
-            '-o', args.systrace_out
-        ]
-        if args.package:
-            cmd.extend(['-a', args.package])
-        
-        trace_categories = args.systrace_categories[:] # Copy list
-        if not args.package and 'app' in trace_categories:
-            trace_categories.remove('app')
-        cmd.extend(trace_categories)
-
-        print(f"--- Starting Systrace process (will run for {args.duration}s)...")
-        # Run Systrace in the background conceptually (subprocess.run blocks, but that's okay)
-        # We launch the app while it's running
-        systrace_proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        trace_started = True # Assume started, will check result later
-        print("--- Systrace process initiated.")
-        time.sleep(1) # Give systrace a moment to initialize fully before launch
-
-    else:
-        print(f"--- ERROR: Unknown tool '{args.tool}'", file=sys.stderr)
+    if args.tool == 'systrace':
+        import systrace_runner
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        device_future = executor.submit(check_device_connected)
+        systrace_future = None
+        if args.tool == 'systrace' and not systrace_script_path:
+            systrace_future = executor.submit(systrace_runner.find_systrace_script)
+        device_ok = device_future.result()
+        if systrace_future:
+            systrace_script_path = systrace_future.result()
+
+    if not device_ok:
         sys.exit(1)
-
-    # --- Launch App (if trace started successfully and not skipping) ---
-    if trace_started and not args.skip_launch:
-        launch_app(args.package, args.activity)
-    elif not trace_started:
-        print("--- Skipping app launch because tracing failed to start.", file=sys.stderr)
-        if args.tool == 'systrace' and 'systrace_proc' in locals():
-             systrace_proc.terminate() # Terminate if it was started but failed conceptually
+    if args.tool == 'systrace' and not systrace_script_path:
         sys.exit(1)
 
+    # Reuse one persistent adb shell session for all device-side commands
+    with AdbShell() as shell:
+        # --- Start Tracing ---
+        trace_started = False
+        trace_ready = False
+        if args.tool == 'perfetto':
+            logger.info("=== Starting Perfetto Test ===")
+            # Perfetto records in a background session on the device, so the app launch below happens inside the trace window
+            ftrace_events = resolve_ftrace_events(shell, args.ftrace_events)
+            broad_process_scan = args.broad_process_scan
+            if args.skip_launch and not broad_process_scan:
+                # The app is not relaunched, so an already running process is only named by the start-up scan
+                app_pid = get_app_pid(shell, args.package)
+                if app_pid:
+                    logger.info("%s is already running (pid %s); enabling the process scan at trace start.", args.package, app_pid)
+                    broad_process_scan = True
+            perfetto_session = start_perfetto_trace(shell, args.package, args.duration, ftrace_events,
+                                                    broad_process_scan, args.perfetto_atrace_categories)
+            trace_started = perfetto_session is not None
+            trace_ready = trace_started and perfetto_session[3]
+
+        elif args.tool == 'atrace':
+            logger.info("=== Starting atrace Test ===")
+            # atrace runs asynchronously on the device, so the app launch below happens inside the trace window
+            atrace_start = start_atrace_trace(shell, args.package, args.systrace_categories)
+            trace_started = atrace_start is not None
+            trace_ready = True # atrace --async_start returns once tracing is enabled
+
+        elif args.tool == 'systrace':
+            logger.info("=== Starting Systrace Test ===")
+            logger.warning("Hint: systrace.py is deprecated; '--tool atrace' captures the same categories without it.")
+            # Systrace needs app launch DURING tracing window
+            # Start systrace command (it will run for args.duration)
+            # We will launch the app immediately after starting the trace process
+            cmd = systrace_runner.build_systrace_cmd(args.package, args.duration, args.systrace_out,
+                                      systrace_script_path, args.systrace_categories)
+
+            logger.info("Starting Systrace process (will run for %ss)...", args.duration)
+            # Run Systrace in the background conceptually (subprocess.run blocks, but that's okay)
+            # We launch the app while it's running
+            # Output goes to temporary files rather than pipes so systrace can never block on a full pipe
+            import tempfile
+            systrace_stdout = tempfile.TemporaryFile()
+            systrace_stderr = tempfile.TemporaryFile()
+            # Unbuffered so its progress output reaches the spool file immediately
+            systrace_proc = subprocess.Popen(cmd, stdout=systrace_stdout, stderr=systrace_stderr,
+                                             env=dict(os.environ, PYTHONUNBUFFERED='1'))
+            trace_started = True # Assume started, will check result later
+            logger.info("Systrace process initiated.")
+            # Launch as soon as systrace reports that tracing is running
+            trace_ready = wait_for_output(systrace_stdout, b"Starting tracing", systrace_proc)
+            if not trace_ready:
+                logger.warning("Did not see systrace start message; launching anyway.")
+
+        else:
+            logger.error("Unknown tool '%s'", args.tool)
+            sys.exit(1)
 
-    # --- Wait for Trace Completion & Collect Results ---
-    if args.tool == 'perfetto':
-        # Perfetto function already handled waiting and pulling
-        print("\n=== Perfetto Test Finished ===")
-        print(f"Trace file: {args.perfetto_out}")
-        print("Analyze using: https://ui.perfetto.dev/")
-
-    elif args.tool == 'systrace':
-        print(f"--- Waiting for Systrace process to complete (max {args.duration}s)...")
-        try:
-            stdout, stderr = systrace_proc.communicate(timeout=args.duration + 10) # Wait a bit longer than duration
-            print("--- Systrace process finished.")
-            if systrace_proc.returncode != 0:
-                 print(f"--- ERROR: Systrace exited with code {systrace_proc.returncode}", file=sys.stderr)
-                 print(f"--- Stdout:\n{stdout}", file=sys.stderr)
-                 print(f"--- Stderr:\n{stderr}", file=sys.stderr)
-                 if os.path.exists(args.systrace_out): # Clean up partial/failed trace
-                    try: os.remove(args.systrace_out)
-                    except OSError: pass
-                 sys.exit(1)
-            elif "Unable to find package" in stdout:
-                 print(f"--- ERROR: Systrace could not find package '{args.package}'.", file=sys.stderr)
-                 if os.path.exists(args.systrace_out): # Clean up partial/failed trace
-                    try: os.remove(args.systrace_out)
-                    except OSError: pass
+        # --- Launch App (if trace started successfully and not skipping) ---
+        if not trace_started:
+            logger.error("Tracing failed to start.")
+            if args.tool == 'systrace' and 'systrace_proc' in locals():
+                 systrace_proc.terminate() # Terminate if it was started but failed conceptually
+            sys.exit(1)
+        launch_thread = None
+        if not args.skip_launch:
+            # The launch runs concurrently while this thread waits for the trace to complete; start_*_trace only
+            # return once the tracer is recording, so the fixed delay applies only when that was not confirmed
+            launch_thread = launch_app_async(shell, args.package, args.activity, args.wait_for_launch,
+                                             trace_ready, args.launch_delay_ms)
+
+
+        # --- Wait for Trace Completion & Collect Results ---
+        if args.tool == 'perfetto':
+            if not finish_perfetto_trace(shell, perfetto_session, args.duration, args.perfetto_out):
+                sys.exit(1)
+            print("\n=== Perfetto Test Finished ===")
+            print(f"Trace file: {args.perfetto_out}")
+            print("Analyze using: https://ui.perfetto.dev/")
+
+        elif args.tool == 'atrace':
+            if not finish_atrace_trace(atrace_start, args.duration, args.atrace_out):
+                sys.exit(1)
+            print("\n=== atrace Test Finished ===")
+            print(f"Trace file: {args.atrace_out}")
+            print("Analyze using: https://ui.perfetto.dev/")
+
+        elif args.tool == 'systrace':
+            logger.info("Waiting for Systrace process to complete (max %ss)...", args.duration)
+            try:
+                systrace_proc.wait(timeout=args.duration + 10) # Wait a bit longer than duration
+                stdout = _read_spooled(systrace_stdout, text=True)
+                stderr = _read_spooled(systrace_stderr, text=True)
+                logger.info("Systrace process finished.")
+                if systrace_proc.returncode != 0:
+                     logger.error("Systrace exited with code %s", systrace_proc.returncode)
+                     logger.error("Stdout:\n%s", stdout)
+                     logger.error("Stderr:\n%s", stderr)
+                     if os.path.exists(args.systrace_out): # Clean up partial/failed trace
+                        try: os.remove(args.systrace_out)
+                        except OSError: pass
+                     sys.exit(1)
+                elif "Unable to find package" in stdout:
+                     logger.error("Systrace could not find package '%s'.", args.package)
+                     if os.path.exists(args.systrace_out): # Clean up partial/failed trace
+                        try: os.remove(args.systrace_out)
+                        except OSError: pass
+                     sys.exit(1)
+
+                print("\n=== Systrace Test Finished ===")
+                print(f"Trace file: {args.systrace_out}")
+                print("Analyze using Chrome browser: chrome://tracing")
+
+            except subprocess.TimeoutExpired:
+                logger.error("Systrace process timed out. Terminating.")
+                systrace_proc.kill()
+                systrace_proc.wait()
+                sys.exit(1)
+            except Exception as e:
+                 logger.error("Error interacting with Systrace process: %s", e)
+                 systrace_proc.kill()
                  sys.exit(1)
 
-            print("\n=== Systrace Test Finished ===")
-            print(f"Trace file: {args.systrace_out}")
-            print("Analyze using Chrome browser: chrome://tracing")
-
-        except subprocess.TimeoutExpired:
-            print("--- ERROR: Systrace process timed out. Terminating.", file=sys.stderr)
-            systrace_proc.kill()
-            stdout, stderr = systrace_proc.communicate()
-            sys.exit(1)
-        except Exception as e:
-             print(f"--- ERROR interacting with Systrace process: {e}", file=sys.stderr)
-             systrace_proc.kill()
-             sys.exit(1)
+        # Keep the shell session open until the launch has finished using it
+        if launch_thread:
+            launch_thread.join()
 
 
 if __name__ == "__main__":